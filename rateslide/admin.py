@@ -9,6 +9,7 @@ from django.http import HttpResponseRedirect
 from nested_admin.nested import NestedModelAdmin, NestedStackedInline, NestedTabularInline
 
 from .models import Case, CaseList, Question, QuestionItem, UserCaseList, CaseSlide, CaseBookmark
+from .anonymous import PURGE_BATCH_SIZE, inactive_anonymous_users
 
 admin.site.register(CaseList)
 admin.site.register(UserCaseList)
@@ -128,14 +129,15 @@ class NewUserAdmin(UserAdmin):
     actions = ['delete_inactive_anonymous_users']
 
     def delete_inactive_anonymous_users(self, request, queryset):
-        anonymous_users = User.objects.filter(first_name='Anonymous', last_name='User')
-        for user in anonymous_users:
-            ucls = UserCaseList.objects.filter(User=user)
-            answered_cases = 0
-            for ucl in ucls:
-                answered_cases += ucl.case_count_completed()
-            if answered_cases == 0:
-                user.delete()
+        # Only the selected users, at most one batch, are deleted in the request, the purge_anonymous_users
+        # management command deletes all inactive anonymous users
+        users = inactive_anonymous_users().filter(pk__in=queryset.values('pk'))
+        batch = list(users.values_list('pk', flat=True)[:PURGE_BATCH_SIZE])
+        deleted = users.filter(pk__in=batch).delete()[1].get(User._meta.label, 0)
+        message = "%d inactive anonymous users were deleted." % deleted
+        if users.exists():
+            message += " Use the purge_anonymous_users management command to delete the others."
+        self.message_user(request, message)
 
 
 admin.site.unregister(User)
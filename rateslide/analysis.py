@@ -0,0 +1,260 @@
+# Analysis of observer variability caselists
+#
+# The answers are loaded into an observers x cases x questions matrix with numpy. Questions are matched between
+# cases by their Order and Type, so questions of different types at the same Order get their own column.
+# numpy is imported by this module, so it is only loaded when an analysis is requested.
+# Agreement statistics are computed over the complete matrix of a question at once. Observers are compared with the
+# consensus of the other observers, the leave-one-out mode for multiple choice and the mean for measurements.
+# The report of a caselist is computed in full, at most once per RATESLIDE_AGREEMENT_INTERVAL while answers of the
+# caselist keep changing.
+#
+from io import BytesIO
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils import timezone
+
+from .caching import cache_timeout, get_version
+from .models import Answer, CaseInstance, Question
+
+MATRIX_CHUNK_SIZE = 5000
+MATRIX_QUESTION_TYPES = (Question.NUMERIC, Question.MULTIPLECHOICE, Question.LINE)
+
+
+def matrix_formats():
+    return ('npz', 'parquet') if pyarrow else ('npz', )
+
+
+def observer_matrix(caselist):
+    """Return the numeric answers of ended caseinstances as an observers x cases x questions matrix
+
+    The result is a dict with the axes 'observers' (user ids), 'cases' (case ids) and 'questions' (question
+    Order), the 'question_types', the 'values' as floats and a 'missing' mask. A column is a question Order and
+    Type, an Order that has different types in different cases has a column for each type. Multiple choice answers
+    are the Order of the chosen item, line answers their length.
+    """
+    answers = Answer.objects.filter(CaseInstance__Case__Caselist=caselist, CaseInstance__Status=CaseInstance.ENDED,
+                                    Question__Type__in=MATRIX_QUESTION_TYPES).order_by().\
+        values_list('CaseInstance__User', 'CaseInstance__Case', 'Question__Order', 'Question__Type',
+                    'AnswerNumeric', 'answerannotation__Length')
+    rows = list(answers.iterator(chunk_size=MATRIX_CHUNK_SIZE))
+    questions = sorted(Question.objects.filter(Case__Caselist=caselist, Type__in=MATRIX_QUESTION_TYPES).order_by().
+                       values_list('Order', 'Type').distinct())
+    column_index = {question: index for index, question in enumerate(questions)}
+    observers = np.unique(np.array([row[0] for row in rows], dtype=np.int64))
+    cases = np.array(sorted(caselist.cases()), dtype=np.int64)
+    values = np.full((len(observers), len(cases), len(questions)), np.nan)
+    if rows:
+        columns = list(zip(*rows))
+        user_ids, case_ids, question_orders, question_types, numeric, length = columns
+        value = np.where(np.array(question_types) == Question.LINE,
+                         np.array([np.nan if x is None else x for x in length], dtype=float),
+                         np.array(numeric, dtype=float))
+        values[np.searchsorted(observers, user_ids), np.searchsorted(cases, case_ids),
+               [column_index[question] for question in zip(question_orders, question_types)]] = value
+    return {'observers': observers,
+            'cases': cases,
+            'questions': np.array([order for order, _ in questions], dtype=np.int64),
+            'question_types': np.array([question_type for _, question_type in questions], dtype='U1'),
+            'values': values,
+            'missing': np.isnan(values)}
+
+
+def write_matrix_npz(matrix, out):
+    np.savez_compressed(out, **matrix)
+
+
+def write_matrix_parquet(matrix, out):
+    # A long table with one row per cell, missing cells are null
+    shape = matrix['values'].shape
+    observer, case, question = np.indices(shape).reshape(3, -1)
+    table = pyarrow.table({
+        'observer': pyarrow.array(matrix['observers'][observer]),
+        'case': pyarrow.array(matrix['cases'][case]),
+        'question': pyarrow.array(matrix['questions'][question]),
+        'question_type': pyarrow.array(matrix['question_types'][question]),
+        'value': pyarrow.array(matrix['values'].ravel(), mask=matrix['missing'].ravel()),
+    })
+    pyarrow.parquet.write_table(table, out)
+
+
+def write_observer_matrix(caselist, out, matrix_format='npz'):
+    if matrix_format not in matrix_formats():
+        raise ValueError('Unsupported matrix format: %s' % matrix_format)
+    matrix = observer_matrix(caselist)
+    if matrix_format == 'parquet':
+        write_matrix_parquet(matrix, out)
+    else:
+        write_matrix_npz(matrix, out)
+
+
+def observer_matrix_bytes(caselist, matrix_format='npz'):
+    out = BytesIO()
+    write_observer_matrix(caselist, out, matrix_format)
+    return out.getvalue()
+
+
+def one_hot(values, missing, categories):
+    # observers x cases x categories, all False where a value is missing
+    return (values[..., None] == categories) & ~missing[..., None]
+
+
+def fleiss_kappa(counts):
+    """Fleiss' kappa from a cases x categories matrix of rating counts, allowing a varying number of raters
+
+    Cases with less than two ratings are left out, None is returned when kappa is not defined.
+    """
+    raters = counts.sum(axis=1)
+    counts = counts[raters >= 2]
+    raters = raters[raters >= 2]
+    if len(raters) == 0:
+        return None
+    agreement = (counts * (counts - 1)).sum(axis=1) / (raters * (raters - 1))
+    proportions = counts.sum(axis=0) / raters.sum()
+    expected = (proportions ** 2).sum()
+    if expected == 1:
+        return None
+    return float((agreement.mean() - expected) / (1 - expected))
+
+
+def cohen_kappa(ratings, reference, categories):
+    # Cohen's kappa between two equally long arrays of ratings
+    if len(ratings) == 0:
+        return None
+    observed = np.mean(ratings == reference)
+    expected = ((ratings[:, None] == categories).mean(axis=0) * (reference[:, None] == categories).mean(axis=0)).sum()
+    if expected == 1:
+        return None
+    return float((observed - expected) / (1 - expected))
+
+
+def choice_agreement(values, missing):
+    """Agreement on a multiple choice question, values is an observers x cases matrix of chosen items
+
+    Returns Fleiss' kappa over all observers, and for each observer Cohen's kappa with and the fraction of
+    disagreement with the consensus of the other observers.
+    """
+    categories = np.unique(values[~missing])
+    ratings = one_hot(values, missing, categories)
+    counts = ratings.sum(axis=0)
+    # Leave one out: the consensus of the others is the most chosen item without the observer's own rating
+    others = counts[None, :, :] - ratings
+    consensus = categories[others.argmax(axis=2)] if len(categories) else np.zeros(values.shape)
+    compared = ~missing & (others.sum(axis=2) > 0)
+    observers = []
+    for index in range(values.shape[0]):
+        rated = compared[index]
+        observers.append({
+            'cases': int(rated.sum()),
+            'kappa': cohen_kappa(values[index, rated], consensus[index, rated], categories),
+            'deviation': float(np.mean(values[index, rated] != consensus[index, rated])) if rated.any() else None})
+    return {'statistic': "Fleiss' kappa", 'value': fleiss_kappa(counts),
+            'cases': int((counts.sum(axis=1) >= 2).sum()), 'observers': observers}
+
+
+def icc_oneway(values, missing):
+    """Intraclass correlation ICC(1) of an observers x cases matrix, for an unbalanced one-way design
+
+    Only cases with at least two measurements are used.
+    """
+    present = ~missing
+    raters = present.sum(axis=0)
+    used = raters >= 2
+    x = np.where(present, values, 0.0)[:, used]
+    present = present[:, used]
+    raters = raters[used]
+    cases = len(raters)
+    total = raters.sum()
+    if cases < 2 or total - cases == 0:
+        return None
+    case_means = x.sum(axis=0) / raters
+    grand_mean = x.sum() / total
+    between = (raters * (case_means - grand_mean) ** 2).sum() / (cases - 1)
+    within = (((x - case_means) ** 2) * present).sum() / (total - cases)
+    k0 = (total - (raters ** 2).sum() / total) / (cases - 1)
+    denominator = between + (k0 - 1) * within
+    if denominator == 0:
+        return None
+    return float((between - within) / denominator)
+
+
+def measurement_agreement(values, missing):
+    """Agreement on a numeric or line question, values is an observers x cases matrix of measurements
+
+    Returns ICC(1) over all observers, and for each observer the Bland-Altman bias and limits of agreement and the
+    mean absolute deviation against the mean of the other observers.
+    """
+    present = ~missing
+    x = np.where(present, values, 0.0)
+    others_count = present.sum(axis=0)[None, :] - present
+    others_sum = x.sum(axis=0)[None, :] - x
+    compared = present & (others_count > 0)
+    differences = np.where(compared, x - others_sum / np.maximum(others_count, 1), np.nan)
+    observers = []
+    for index in range(values.shape[0]):
+        difference = differences[index][compared[index]]
+        observer = {'cases': len(difference), 'bias': None, 'lower': None, 'upper': None, 'deviation': None}
+        if len(difference) > 0:
+            observer['bias'] = float(difference.mean())
+            observer['deviation'] = float(np.abs(difference).mean())
+            if len(difference) > 1:
+                spread = 1.96 * float(difference.std(ddof=1))
+                observer['lower'] = observer['bias'] - spread
+                observer['upper'] = observer['bias'] + spread
+        observers.append(observer)
+    return {'statistic': 'ICC(1)', 'value': icc_oneway(values, missing),
+            'cases': int((present.sum(axis=0) >= 2).sum()), 'observers': observers}
+
+
+def agreement_report(caselist):
+    """Compute the agreement statistics of every question of an observer variability caselist"""
+    matrix = observer_matrix(caselist)
+    usernames = dict(User.objects.filter(pk__in=matrix['observers'].tolist()).values_list('pk', 'username'))
+    texts = {(order, question_type): text for order, question_type, text in
+             Question.objects.filter(Case__Caselist=caselist, Order__in=matrix['questions'].tolist()).
+             order_by('-Case').values_list('Order', 'Type', 'Text')}
+    questions = []
+    for index, (order, question_type) in enumerate(zip(matrix['questions'].tolist(),
+                                                       matrix['question_types'].tolist())):
+        values = matrix['values'][:, :, index]
+        missing = matrix['missing'][:, :, index]
+        if question_type == Question.MULTIPLECHOICE:
+            agreement = choice_agreement(values, missing)
+        else:
+            agreement = measurement_agreement(values, missing)
+        for user_id, observer in zip(matrix['observers'].tolist(), agreement['observers']):
+            observer['user'] = usernames.get(user_id, user_id)
+        agreement['observers'] = [observer for observer in agreement['observers'] if observer['cases'] > 0]
+        agreement.update({'order': order, 'type': question_type, 'text': texts.get((order, question_type))})
+        questions.append(agreement)
+    return questions
+
+
+def agreement_interval():
+    return getattr(settings, 'RATESLIDE_AGREEMENT_INTERVAL', 300)
+
+
+def cached_agreement_report(caselist):
+    """Return the agreement report of a caselist as a dict of the 'questions' and the time it was 'computed'
+
+    Submitting or removing answers of the caselist bumps the version of the report. A report of an older version is
+    still returned until it is RATESLIDE_AGREEMENT_INTERVAL seconds old, so while observers are submitting the
+    report is computed at most once per interval instead of after every submission.
+    """
+    version = get_version('agreement', caselist.pk)
+    key = 'rateslide:agreement:%s' % caselist.pk
+    report = cache.get(key)
+    if report is None or (report['version'] != version and
+                          (timezone.now() - report['computed']).total_seconds() >= agreement_interval()):
+        report = {'version': version, 'computed': timezone.now(), 'questions': agreement_report(caselist)}
+        cache.set(key, report, cache_timeout())
+    return report
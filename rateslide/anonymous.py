@@ -0,0 +1,52 @@
+# Anonymous participants of caselists that are visible for non users
+#
+# The users created for anonymous visitors are marked with an AnonymousParticipant row.
+# Anonymous users that never ended a case are removed with set based queries. The rows are deleted in batches of
+# primary keys, each in its own transaction, so a purge of many users does not hold long locks.
+#
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from .models import CaseInstance, UserCaseList
+
+PURGE_BATCH_SIZE = 1000
+
+
+def anonymous_users():
+    return User.objects.filter(anonymousparticipant__isnull=False)
+
+
+def inactive_anonymous_users(joined_before=None):
+    """Return the anonymous users that did not end any case, optionally only those that joined before a date"""
+    ended = CaseInstance.objects.filter(User=OuterRef('pk'), Status=CaseInstance.ENDED)
+    users = anonymous_users().filter(~Exists(ended))
+    if joined_before is not None:
+        users = users.filter(date_joined__lt=joined_before)
+    return users
+
+
+def inactive_anonymous_usercaselists(caselist):
+    # Memberships of anonymous users that did not end a case of the caselist, the users are kept
+    ended = CaseInstance.objects.filter(User=OuterRef('User'), Case__Caselist=caselist, Status=CaseInstance.ENDED)
+    return UserCaseList.objects.filter(CaseList=caselist, User__anonymousparticipant__isnull=False).\
+        filter(~Exists(ended))
+
+
+def delete_in_batches(queryset, batch_size=PURGE_BATCH_SIZE, progress=None):
+    """Delete the rows of a queryset in batches, return the number of rows deleted
+
+    The queryset is evaluated again for every batch, so rows that no longer match, e.g. users that ended a case in
+    the meantime, are kept. progress is called with the number of rows deleted so far.
+    """
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if pks:
+                queryset.filter(pk__in=pks).delete()
+        if not pks:
+            return deleted
+        deleted += len(pks)
+        if progress is not None:
+            progress(deleted)
@@ -0,0 +1,171 @@
+# Assignment of cases to the users of a caselist
+#
+# The next case is selected by the database in a single query. Optionally a queue of case ids is prepared per user
+# and kept in the cache, so a request for the next case only has to verify the head of the queue.
+# When the number of observers per case is limited, a case is reserved with an OPEN caseinstance. The reservation
+# is made while holding a lock on the row of that case only, so users that get different cases do not wait for
+# each other. Reservations that expired are not counted, they are removed when their case is reserved again.
+# A submission without a caseinstance, for instance after the reservation expired and was given to another user,
+# takes the same lock and checks the limit again.
+#
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .models import Case, CaseInstance
+
+NO_CASE = -1
+RESERVE_ATTEMPTS = 5
+
+
+def queue_enabled():
+    return getattr(settings, 'RATESLIDE_CASE_QUEUE', False)
+
+
+def queue_timeout():
+    return getattr(settings, 'RATESLIDE_CASE_QUEUE_TIMEOUT', 3600)
+
+
+def reservation_timeout():
+    return getattr(settings, 'RATESLIDE_RESERVATION_TIMEOUT', 3600)
+
+
+def queue_key(caselist, user_id):
+    return 'rateslide:casequeue:%d:%d' % (caselist.pk, user_id)
+
+
+def candidate_cases(caselist, user_id):
+    """Return the cases a user has not seen yet, in order of preference
+
+    Cases with the lowest Order come first. When the number of observers per case is limited the cases that were
+    observed least come first. Ties are broken at random for observer variability lists and for limited lists.
+    """
+    cases = Case.objects.filter(Caselist=caselist)
+    if user_id is not None:
+        # A visitor that is not stored yet has not seen any case
+        cases = cases.exclude(caseinstance__User=user_id)
+    if caselist.ObserversPerCase == 0:
+        if caselist.Type == caselist.OBSERVER:
+            return cases.order_by('Order', '?')
+        else:
+            return cases.order_by('Order', 'Name')
+    else:
+        # Skipped caseinstances and expired reservations are not an observation, cases that reached the limit are
+        # not a candidate
+        observers = Count('caseinstance', filter=Q(caseinstance__Status=CaseInstance.ENDED) |
+                          Q(caseinstance__Status=CaseInstance.OPEN, caseinstance__Reserved__gte=reservation_deadline()))
+        return cases.annotate(observers=observers).filter(observers__lt=caselist.ObserversPerCase).\
+            order_by('observers', '?')
+
+
+def select_next_case(caselist, user_id):
+    # Select the best candidate in one query
+    case_id = candidate_cases(caselist, user_id).values_list('pk', flat=True).first()
+    return NO_CASE if case_id is None else case_id
+
+
+def build_queue(caselist, user_id):
+    # The complete order of candidates is stored, it only depends on the user when there is no observer limit
+    queue = list(candidate_cases(caselist, user_id).values_list('pk', flat=True))
+    cache.set(queue_key(caselist, user_id), queue, queue_timeout())
+    return queue
+
+
+def next_queued_case(caselist, user_id):
+    """Return the head of the queue of a user, verified against the database
+
+    Cases that have been seen in the meantime, or that are removed from the caselist, are popped. An exhausted
+    queue is rebuilt, so cases added to the caselist are picked up.
+    """
+    key = queue_key(caselist, user_id)
+    queue = cache.get(key)
+    if queue is None:
+        queue = build_queue(caselist, user_id)
+    popped = False
+    while queue:
+        if Case.objects.filter(pk=queue[0], Caselist=caselist).exclude(caseinstance__User=user_id).exists():
+            break
+        queue.pop(0)
+        popped = True
+    if not queue:
+        queue = build_queue(caselist, user_id)
+    elif popped:
+        cache.set(key, queue, queue_timeout())
+    return queue[0] if queue else NO_CASE
+
+
+def reservation_deadline():
+    # Reservations made before the deadline have expired
+    return timezone.now() - timedelta(seconds=reservation_timeout())
+
+
+def reserve_case(caselist, user_id):
+    """Reserve a case for a user with an OPEN caseinstance, respecting ObserversPerCase
+
+    A user that still holds a reservation gets the same case again, an expired reservation of the user is removed
+    so the case can be selected again. When another user filled the selected case first, the next candidate is
+    tried.
+    """
+    deadline = reservation_deadline()
+    reservations = CaseInstance.objects.filter(Case__Caselist=caselist, User=user_id, Status=CaseInstance.OPEN)
+    reserved = reservations.filter(Reserved__gte=deadline).values_list('Case', flat=True).first()
+    if reserved is not None:
+        return reserved
+    reservations.filter(Reserved__lt=deadline).delete()
+    for _ in range(RESERVE_ATTEMPTS):
+        case_id = select_next_case(caselist, user_id)
+        if case_id == NO_CASE:
+            return NO_CASE
+        with transaction.atomic():
+            # Only users that selected the same case wait for this lock, the expired reservations of the case are
+            # given to others
+            case = Case.objects.select_for_update().get(pk=case_id)
+            CaseInstance.objects.filter(Case=case, Status=CaseInstance.OPEN, Reserved__lt=deadline).delete()
+            observers = CaseInstance.objects.filter(Case=case).exclude(Status=CaseInstance.SKIPPED)
+            if observers.count() < caselist.ObserversPerCase and not observers.filter(User=user_id).exists():
+                CaseInstance.objects.create(Case=case, User_id=user_id, Status=CaseInstance.OPEN,
+                                            Reserved=timezone.now())
+                return case_id
+    return NO_CASE
+
+
+def submission_caseinstance(case, user_id):
+    """Return the caseinstance that receives the answers of a user to a case, None when the case is full
+
+    Call within the transaction that saves the answers. The user's own caseinstance is used, also a reservation that
+    expired but was not given away. Otherwise a new ENDED caseinstance is only created when the case has not reached
+    ObserversPerCase.
+    """
+    caselist = case.Caselist
+    if caselist.ObserversPerCase == 0:
+        return CaseInstance.objects.get_or_create(Case=case, User_id=user_id,
+                                                  defaults={'Status': CaseInstance.ENDED})[0]
+    # Reservations of the case are made and removed under this lock
+    Case.objects.select_for_update().get(pk=case.pk)
+    caseinstance = CaseInstance.objects.filter(Case=case, User=user_id).first()
+    if caseinstance is None:
+        observers = CaseInstance.objects.filter(Q(Status=CaseInstance.ENDED) |
+                                                Q(Status=CaseInstance.OPEN, Reserved__gte=reservation_deadline()),
+                                                Case=case)
+        if observers.count() >= caselist.ObserversPerCase:
+            return None
+        caseinstance = CaseInstance.objects.create(Case=case, User_id=user_id, Status=CaseInstance.ENDED)
+    return caseinstance
+
+
+def next_case(caselist, user_id):
+    """Return the id of the next case for a user, or NO_CASE when all cases are done
+
+    A queue is only used when the number of observers per case is not limited, otherwise the choice depends on the
+    work of other users and the case is reserved.
+    """
+    if caselist.ObserversPerCase > 0:
+        return reserve_case(caselist, user_id)
+    elif queue_enabled() and user_id is not None:
+        return next_queued_case(caselist, user_id)
+    else:
+        return select_next_case(caselist, user_id)
@@ -0,0 +1,47 @@
+# Shared cache helpers
+#
+# Cached values are stored under a key that contains a version token. Changing the token, usually from a signal
+# handler, makes all values stored under the old token unreachable. A random token is used, so a version that
+# was evicted from the cache can never bring back an old value.
+#
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def cache_timeout():
+    return getattr(settings, 'RATESLIDE_CACHE_TIMEOUT', 3600)
+
+
+def version_key(name, pk):
+    return 'rateslide:version:%s:%s' % (name, pk)
+
+
+def get_version(name, pk):
+    key = version_key(name, pk)
+    version = cache.get(key)
+    if version is None:
+        version = uuid4().hex
+        # add does not overwrite a version that was set in the meantime
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(name, pk):
+    cache.set(version_key(name, pk), uuid4().hex, None)
+
+
+def versioned_key(name, pk):
+    return 'rateslide:%s:%s:%s' % (name, pk, get_version(name, pk))
+
+
+def get_or_build(name, pk, build, timeout=None):
+    """Return the cached value for name and pk, or store the result of build()"""
+    key = versioned_key(name, pk)
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, cache_timeout() if timeout is None else timeout)
+    return value
@@ -0,0 +1,63 @@
+# Export of the answers of a caselist
+#
+# Rows are read with a server side cursor where the database supports it and written one at a time, so memory use
+# does not depend on the number of answers.
+#
+import csv
+
+from .models import Answer
+
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_COLUMNS = (
+    ('user_id', 'CaseInstance__User'),
+    ('username', 'CaseInstance__User__username'),
+    ('case_id', 'CaseInstance__Case'),
+    ('case', 'CaseInstance__Case__Name'),
+    ('question_id', 'Question'),
+    ('question_order', 'Question__Order'),
+    ('question', 'Question__Text'),
+    ('type', 'Question__Type'),
+    ('numeric', 'AnswerNumeric'),
+    ('text', 'AnswerText'),
+    ('choice', 'choice_text'),
+    ('length', 'answerannotation__Length'),
+    ('length_unit', 'answerannotation__LengthUnit'),
+    ('status', 'CaseInstance__Status'),
+    ('start_time', 'CaseInstance__StartTime'),
+    ('end_time', 'CaseInstance__EndTime'),
+)
+
+EXPORT_FORMATS = {'csv': ',', 'tsv': '\t'}
+
+
+def answer_rows(caselist):
+    """Yield a header and a row for every answer in a caselist
+
+    The text of multiple choice items is joined by the database, in stead of being looked up per answer.
+    """
+    yield [name for name, _ in EXPORT_COLUMNS]
+    answers = Answer.objects.filter(CaseInstance__Case__Caselist=caselist).with_choice_text().\
+        order_by('CaseInstance', 'Question').values_list(*[field for _, field in EXPORT_COLUMNS])
+    for row in answers.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield ['' if value is None else value.isoformat() if hasattr(value, 'isoformat') else value
+               for value in row]
+
+
+class Echo:
+    """An object that implements just the write method of the file-like interface, for streaming csv
+    """
+    def write(self, value):
+        return value
+
+
+def export_lines(caselist, export_format='csv'):
+    # Generate the formatted lines of the export
+    writer = csv.writer(Echo(), delimiter=EXPORT_FORMATS[export_format])
+    for row in answer_rows(caselist):
+        yield writer.writerow(row)
+
+
+def write_export(caselist, out, export_format='csv'):
+    for line in export_lines(caselist, export_format):
+        out.write(line)
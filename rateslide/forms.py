@@ -6,6 +6,7 @@ from django.forms.models import modelformset_factory
 from django.forms.widgets import HiddenInput, RadioSelect, Textarea
 from django.utils.translation import gettext_lazy as _
 
+from .caching import get_or_build
 from .models import Question, CaseList, UserCaseList, QuestionItem, CaseBookmark, Case, CaseInstance, \
     QuestionBookmark, Answer
 
@@ -106,57 +107,91 @@ class LineField(Field):
     widget = LineInput
 
 
+def build_question_schema(case_id):
+    # Everything needed to create the fields of a QuestionForm, in three queries
+    choices = {}
+    for question_id, order, text in QuestionItem.objects.filter(Question__Case=case_id).\
+            order_by('Question', 'Order').values_list('Question', 'Order', 'Text'):
+        choices.setdefault(question_id, []).append((order, text))
+    bookmarks = {}
+    for bookmark in QuestionBookmark.objects.filter(Question__Case=case_id).order_by('order').\
+            values('pk', 'Text', 'Question'):
+        bookmarks.setdefault(bookmark.pop('Question'), []).append(bookmark)
+    return [{'pk': question.pk,
+             'fieldid': question.fieldid(),
+             'Type': question.Type,
+             'Text': question.Text,
+             'Required': question.Required,
+             'choices': choices.get(question.pk, []),
+             'bookmarks': bookmarks.get(question.pk, [])}
+            for question in Question.objects.filter(Case=case_id)]
+
+
+def question_schema(case):
+    """Return the cached field schema of the questions of a case
+
+    The cache is invalidated by signals on Question, QuestionItem and QuestionBookmark
+    """
+    return get_or_build('questionschema', case.pk, lambda: build_question_schema(case.pk))
+
+
 class QuestionForm(Form):
     def __init__(self, case, user, data=None, *args, **kwargs):
-        questions = Question.objects.filter(Case=case)
+        questions = question_schema(case)
         if not data:
-            caseinstance = None if user is None else CaseInstance.objects.filter(Case=case, User=user).first()
+            caseinstance = None if user is None or user.pk is None else \
+                CaseInstance.objects.filter(Case=case, User=user).first()
             if caseinstance:
                 data = {}
-                answers = Answer.objects.filter(CaseInstance=caseinstance).select_related('Question')
+                fields = {question['pk']: question for question in questions}
+                answers = Answer.objects.filter(CaseInstance=caseinstance).select_related('answerannotation')
                 for answer in answers:
-                    if answer.Question.Type in (Question.NUMERIC, Question.MULTIPLECHOICE):
-                        data[answer.Question.fieldid()] = answer.AnswerNumeric
-                    elif answer.Question.Type == Question.LINE:
+                    question = fields.get(answer.Question_id)
+                    if not question:
+                        continue
+                    if question['Type'] in (Question.NUMERIC, Question.MULTIPLECHOICE):
+                        data[question['fieldid']] = answer.AnswerNumeric
+                    elif question['Type'] == Question.LINE:
                         if hasattr(answer, 'answerannotation'):
                             annotation = loads(answer.answerannotation.AnnotationJSON)
-                            data[answer.Question.fieldid()] = dumps({'length': answer.answerannotation.Length,
-                                                                     'length_unit': answer.answerannotation.LengthUnit,
-                                                                     'slideid': answer.answerannotation.Slide_id,
-                                                                     'annotation': annotation})
-                            data[answer.Question.fieldid() + '-length'] = \
+                            data[question['fieldid']] = dumps({'length': answer.answerannotation.Length,
+                                                               'length_unit': answer.answerannotation.LengthUnit,
+                                                               'slideid': answer.answerannotation.Slide_id,
+                                                               'annotation': annotation})
+                            data[question['fieldid'] + '-length'] = \
                                 "{0:.3g} {1}".format(answer.answerannotation.Length,
                                                      answer.answerannotation.LengthUnit)
                     else:
-                        data[answer.Question.fieldid()] = answer.AnswerText
+                        data[question['fieldid']] = answer.AnswerText
 
         super(QuestionForm, self).__init__(data, *args, **kwargs)
         for question in questions:
-            if question.Type == Question.NUMERIC:
-                field = IntegerField(label=question.Text)
-            elif question.Type == Question.MULTIPLECHOICE: 
+            fieldid = question['fieldid']
+            if question['Type'] == Question.NUMERIC:
+                field = IntegerField(label=question['Text'])
+            elif question['Type'] == Question.MULTIPLECHOICE:
                 field = TypedChoiceField(
-                    label=question.Text,
-                    choices=QuestionItem.objects.filter(Question=question.id).values_list('Order', 'Text'),
+                    label=question['Text'],
+                    choices=question['choices'],
                     coerce=int, widget=RadioSelect(attrs={'class': 'form-button-radio'}))
-            elif question.Type == Question.DATE: 
-                field = DateField(label=question.Text)
-            elif question.Type == Question.REMARK:
-                field = CharField(label=question.Text, widget=HiddenInput)
+            elif question['Type'] == Question.DATE:
+                field = DateField(label=question['Text'])
+            elif question['Type'] == Question.REMARK:
+                field = CharField(label=question['Text'], widget=HiddenInput)
                 # Add a list of bookmarks {pk, Text} to the value attribute of a hidden input
-                field.widget.attrs.update({'question': question.pk, 'bookmarks': question.bookmarks()})
-            elif question.Type == Question.LINE:
-                field = LineField(label=question.Text)
-                if data and question.fieldid() in data:
-                    if question.fieldid() + '-length' in data:
-                        field.widget.attrs.update({'line_length': data[question.fieldid() + '-length']})
-                    field.initial = data[question.fieldid()]
+                field.widget.attrs.update({'question': question['pk'], 'bookmarks': question['bookmarks']})
+            elif question['Type'] == Question.LINE:
+                field = LineField(label=question['Text'])
+                if data and fieldid in data:
+                    if fieldid + '-length' in data:
+                        field.widget.attrs.update({'line_length': data[fieldid + '-length']})
+                    field.initial = data[fieldid]
             else:  # Use Question.OPENTEXT as fallthrough/default
-                field = CharField(label=question.Text, widget=Textarea)
+                field = CharField(label=question['Text'], widget=Textarea)
 
-            field.required = question.Required
+            field.required = question['Required']
 
-            self.fields[question.fieldid()] = field
+            self.fields[fieldid] = field
 
 
 class CaseBookmarkForm(ModelForm):
@@ -0,0 +1,113 @@
+# Delivery of mail to the members of caselists
+#
+# Mail is put in the outbox as OutgoingMail rows. With RATESLIDE_MAIL_OUTBOX set, the send_mail_outbox management
+# command delivers it in the background, otherwise the mail that is queued is delivered at once, without waiting
+# for the rate limit, and mail that failed is left for the command. Either way the messages are sent over
+# a single connection to the mail server. Mail is claimed by a worker for MAIL_LEASE seconds, so workers running
+# at the same time do not send it twice, and a mail that fails is retried with an increasing delay.
+#
+from datetime import timedelta
+from time import sleep
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutgoingMail
+from .utils import MailRenderer
+
+MAIL_LEASE = 600
+MAIL_BATCH_SIZE = 100
+
+
+def outbox_enabled():
+    return getattr(settings, 'RATESLIDE_MAIL_OUTBOX', False)
+
+
+def mail_rate():
+    # Maximum number of messages per second, 0 is not limited
+    return getattr(settings, 'RATESLIDE_MAIL_RATE', 0)
+
+
+def mail_attempts():
+    return getattr(settings, 'RATESLIDE_MAIL_ATTEMPTS', 5)
+
+
+def queue_mail(usercaselist_ids, mail_type):
+    """Put a mail for each usercaselist in the outbox, it is sent at once when there is no outbox worker
+
+    Only the mail queued here is sent at once, other mail in the outbox is not delivered by the request.
+    """
+    mails = OutgoingMail.objects.bulk_create([OutgoingMail(UserCaseList_id=usercaselist_id, MailType=mail_type)
+                                              for usercaselist_id in usercaselist_ids])
+    if mails and not outbox_enabled():
+        # bulk_create does not return primary keys on every database, mail that was never attempted is selected
+        queued = due_mail().filter(UserCaseList__in=usercaselist_ids, MailType=mail_type, Attempts=0)
+        send_outbox(len(mails), queued, rate=0)
+    return len(mails)
+
+
+def due_mail():
+    return OutgoingMail.objects.filter(Sent__isnull=True, NextAttempt__lte=timezone.now(),
+                                       Attempts__lt=mail_attempts())
+
+
+def claim_mail(batch_size, outbox):
+    # Claimed mail is not due for the duration of the lease, other workers skip it
+    with transaction.atomic():
+        mail_ids = list(outbox.select_for_update(skip_locked=True).order_by('NextAttempt').
+                        values_list('pk', flat=True)[:batch_size])
+        OutgoingMail.objects.filter(pk__in=mail_ids).\
+            update(NextAttempt=timezone.now() + timedelta(seconds=MAIL_LEASE), Attempts=F('Attempts') + 1)
+    return list(OutgoingMail.objects.filter(pk__in=mail_ids).
+                select_related('UserCaseList__User', 'UserCaseList__CaseList__Owner'))
+
+
+def build_message(mail, connection, renderer):
+    usercaselist = mail.UserCaseList
+    return EmailMessage(mail.MailType, renderer.render(usercaselist, mail.MailType),
+                        usercaselist.CaseList.Owner.email, [usercaselist.User.email], connection=connection)
+
+
+def send_outbox(batch_size=MAIL_BATCH_SIZE, outbox=None, rate=None):
+    """Send all mail that is due, return the number of mails that were sent and that failed
+
+    outbox limits the sending to a queryset of due mail, rate overrides the RATESLIDE_MAIL_RATE setting. Besides
+    claiming and marking a batch, the mail costs no queries, its rows come with their user and caselist.
+    """
+    sent = failed = 0
+    if outbox is None:
+        outbox = due_mail()
+    if rate is None:
+        rate = mail_rate()
+    renderer = MailRenderer()
+    connection = get_connection()
+    connection.open()
+    try:
+        while True:
+            batch = claim_mail(batch_size, outbox)
+            if not batch:
+                break
+            sent_ids = []
+            for mail in batch:
+                try:
+                    connection.send_messages([build_message(mail, connection, renderer)])
+                except Exception as error:
+                    # Try again later, the connection may be broken
+                    mail.Error = str(error)
+                    mail.NextAttempt = timezone.now() + timedelta(minutes=2 ** mail.Attempts)
+                    mail.save(update_fields=['Error', 'NextAttempt'])
+                    failed += 1
+                    connection.close()
+                    connection.open()
+                else:
+                    sent_ids.append(mail.pk)
+                if rate:
+                    sleep(1 / rate)
+            OutgoingMail.objects.filter(pk__in=sent_ids).update(Sent=timezone.now(), Error='')
+            sent += len(sent_ids)
+    finally:
+        connection.close()
+    return sent, failed
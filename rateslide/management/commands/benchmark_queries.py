@@ -0,0 +1,46 @@
+from statistics import median
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rateslide.models import Answer, Case, CaseInstance, UserCaseList
+
+
+def hot_queries():
+    """The lookups of the participant pages, with their parameters taken from the most recent answer"""
+    answer = Answer.objects.select_related('CaseInstance__Case').order_by('-pk').first()
+    if answer is None:
+        return None
+    instance = answer.CaseInstance
+    return [
+        ('usercaselist of user', UserCaseList.objects.filter(User=instance.User_id,
+                                                              CaseList=instance.Case.Caselist_id)),
+        ('caseinstance of user and case', CaseInstance.objects.filter(User=instance.User_id, Case=instance.Case_id,
+                                                                      Status=CaseInstance.ENDED)),
+        ('answer of caseinstance and question', Answer.objects.filter(CaseInstance=instance,
+                                                                      Question=answer.Question_id)),
+        ('answers of question', Answer.objects.filter(Question=answer.Question_id).order_by()),
+        ('cases of caselist', Case.objects.filter(Caselist=instance.Case.Caselist_id).order_by('Order')),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Show the query plans and timings of the hot lookups on the current database, run it before and after ' \
+           'migrating to compare, e.g. with migrate rateslide 0012 and migrate rateslide 0013'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=50, help='Number of times each query is timed')
+
+    def handle(self, *args, **options):
+        queries = hot_queries()
+        if queries is None:
+            raise CommandError('There are no answers to benchmark with')
+        for name, queryset in queries:
+            timings = []
+            for _ in range(options['repeat']):
+                start = perf_counter()
+                list(queryset.all())
+                timings.append(perf_counter() - start)
+            self.stdout.write('%s: median %.3f ms, max %.3f ms' % (name, median(timings) * 1000, max(timings) * 1000))
+            self.stdout.write(queryset.explain())
+            self.stdout.write('')
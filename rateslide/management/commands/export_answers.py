@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rateslide.export import EXPORT_FORMATS, write_export
+from rateslide.models import CaseList
+
+
+class Command(BaseCommand):
+    help = 'Export all answers of a caselist, one row per answer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slug', help='Slug of the caselist')
+        parser.add_argument('--format', default='csv', choices=sorted(EXPORT_FORMATS), help='Output format')
+        parser.add_argument('--output', help='Output file, default standard output')
+
+    def handle(self, *args, **options):
+        try:
+            caselist = CaseList.objects.get(Slug=options['slug'])
+        except CaseList.DoesNotExist:
+            raise CommandError('Unknown caselist: %s' % options['slug'])
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as out:
+                write_export(caselist, out, options['format'])
+        else:
+            write_export(caselist, self.stdout, options['format'])
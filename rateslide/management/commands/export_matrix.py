@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rateslide.analysis import matrix_formats, write_observer_matrix
+from rateslide.models import CaseList
+
+
+class Command(BaseCommand):
+    help = 'Export the numeric answers of a caselist as an observers x cases x questions matrix'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slug', help='Slug of the caselist')
+        parser.add_argument('output', help='Output file')
+        parser.add_argument('--format', default='npz', choices=('npz', 'parquet'),
+                            help='npz for numpy, parquet needs pyarrow')
+
+    def handle(self, *args, **options):
+        if options['format'] not in matrix_formats():
+            raise CommandError('Format %s is not available, install pyarrow' % options['format'])
+        try:
+            caselist = CaseList.objects.get(Slug=options['slug'])
+        except CaseList.DoesNotExist:
+            raise CommandError('Unknown caselist: %s' % options['slug'])
+        with open(options['output'], 'wb') as out:
+            write_observer_matrix(caselist, out, options['format'])
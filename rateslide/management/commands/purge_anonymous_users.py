@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from rateslide.anonymous import PURGE_BATCH_SIZE, delete_in_batches, inactive_anonymous_users
+
+
+class Command(BaseCommand):
+    help = 'Delete anonymous users that did not end any case'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=0, metavar='DAYS',
+                            help='Only delete users that joined more than DAYS days ago')
+        parser.add_argument('--batch-size', type=int, default=PURGE_BATCH_SIZE,
+                            help='Number of users deleted per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the users that would be deleted')
+
+    def handle(self, *args, **options):
+        joined_before = None
+        if options['older_than']:
+            joined_before = timezone.now() - timedelta(days=options['older_than'])
+        users = inactive_anonymous_users(joined_before)
+        if options['dry_run']:
+            self.stdout.write('%d anonymous users would be deleted' % users.count())
+            return
+        deleted = delete_in_batches(users, options['batch_size'],
+                                    lambda count: self.stdout.write('Deleted %d anonymous users' % count))
+        self.stdout.write('Done, %d anonymous users deleted' % deleted)
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rateslide.models import CaseList, Question, QuestionStatistics, TextSketch, text_sketch_size
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the running statistics of numeric, multiple choice and line questions and the sketches of ' \
+           'open text questions from their answers, needed after answers have been changed outside of submitting cases'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*', help='Slugs of the caselists, default all caselists')
+
+    def handle(self, *args, **options):
+        caselists = CaseList.objects.all()
+        if options['slugs']:
+            caselists = caselists.filter(Slug__in=options['slugs'])
+            missing = set(options['slugs']).difference(caselists.values_list('Slug', flat=True))
+            if missing:
+                raise CommandError('Unknown caselist: %s' % ', '.join(sorted(missing)))
+        for caselist in caselists:
+            questions = Question.objects.filter(Case__Caselist=caselist, Type__in=QuestionStatistics.QUESTION_TYPES).\
+                values_list('pk', 'Type')
+            for question_id, question_type in questions:
+                QuestionStatistics.rebuild(question_id, question_type)
+            texts = []
+            if text_sketch_size():
+                texts = Question.objects.filter(Case__Caselist=caselist, Type=Question.OPENTEXT).\
+                    values_list('pk', flat=True)
+                for question_id in texts:
+                    TextSketch.rebuild(question_id, text_sketch_size())
+            self.stdout.write('%s: %d questions, %d open text questions' % (caselist.Slug, len(questions), len(texts)))
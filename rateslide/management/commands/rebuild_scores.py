@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rateslide.models import CaseList
+
+
+class Command(BaseCommand):
+    help = 'Regrade the answers of examination caselists and rebuild the stored scores, ' \
+           'needed after correct answers have been changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*', help='Slugs of the caselists, default all examination caselists')
+
+    def handle(self, *args, **options):
+        if options['slugs']:
+            caselists = CaseList.objects.filter(Slug__in=options['slugs'])
+            missing = set(options['slugs']).difference(caselists.values_list('Slug', flat=True))
+            if missing:
+                raise CommandError('Unknown caselist: %s' % ', '.join(sorted(missing)))
+        else:
+            caselists = CaseList.objects.filter(Type=CaseList.EXAMINATION)
+        for caselist in caselists:
+            caselist.rebuild_scores()
+            self.stdout.write('%s: %d scores' % (caselist.Slug, caselist.scores().count()))
@@ -0,0 +1,24 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from rateslide.mail import MAIL_BATCH_SIZE, send_outbox
+
+
+class Command(BaseCommand):
+    help = 'Send the mail in the outbox that is due, used when RATESLIDE_MAIL_OUTBOX is set'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=MAIL_BATCH_SIZE,
+                            help='Number of mails claimed at once')
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help='Keep running, looking for new mail every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_outbox(options['batch_size'])
+            if sent or failed or options['verbosity'] > 1:
+                self.stdout.write('Sent %d mails, %d failed' % (sent, failed))
+            if not options['loop']:
+                break
+            sleep(options['loop'])
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:05
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_reservation_times(apps, schema_editor):
+    # Open caseinstances were reserved when they were last saved
+    CaseInstance = apps.get_model('rateslide', 'CaseInstance')
+    CaseInstance.objects.filter(Status='O').update(Reserved=F('EndTime'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rateslide', '0008_caselist_slidebase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='caseinstance',
+            name='Reserved',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_reservation_times, migrations.RunPython.noop),
+    ]
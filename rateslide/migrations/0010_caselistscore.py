@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rateslide', '0009_caseinstance_reserved'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaseListScore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('Correct', models.IntegerField(default=0)),
+                ('Graded', models.IntegerField(default=0)),
+                ('CaseList', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rateslide.caselist')),
+                ('User', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('User', 'CaseList')},
+            },
+        ),
+    ]
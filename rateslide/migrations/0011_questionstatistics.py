@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rateslide', '0010_caselistscore'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('Count', models.IntegerField(default=0)),
+                ('Mean', models.FloatField(default=0)),
+                ('SumSquares', models.FloatField(default=0)),
+                ('Min', models.FloatField(null=True)),
+                ('Max', models.FloatField(null=True)),
+                ('Counts', models.TextField(default='{}')),
+                ('Question', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='rateslide.question')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rateslide', '0011_questionstatistics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TextSketch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('Total', models.IntegerField(default=0)),
+                ('Items', models.TextField(default='{}')),
+                ('Question', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='rateslide.question')),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+# Status that is kept when a user has several rows for the same caselist
+STATUS_PRIORITY = {'C': 0, 'A': 1, 'P': 2}
+
+
+def remove_duplicate_usercaselists(apps, schema_editor):
+    # Concurrent first visits could add a user to a caselist twice, the oldest row is kept with the most advanced status
+    UserCaseList = apps.get_model('rateslide', 'UserCaseList')
+    duplicates = UserCaseList.objects.values('User', 'CaseList').annotate(rows=models.Count('pk')).filter(rows__gt=1)
+    for duplicate in duplicates:
+        rows = list(UserCaseList.objects.filter(User=duplicate['User'], CaseList=duplicate['CaseList']).order_by('pk'))
+        keep = rows[0]
+        keep.Status = min((row.Status for row in rows), key=lambda status: STATUS_PRIORITY.get(status, 3))
+        keep.save(update_fields=['Status'])
+        UserCaseList.objects.filter(pk__in=[row.pk for row in rows[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rateslide', '0012_textsketch'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_usercaselists, migrations.RunPython.noop),
+    ]
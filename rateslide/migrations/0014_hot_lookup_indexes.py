@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rateslide', '0013_remove_duplicate_usercaselists'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='usercaselist',
+            unique_together={('User', 'CaseList')},
+        ),
+        migrations.AddIndex(
+            model_name='case',
+            index=models.Index(fields=['Caselist', 'Order'], name='case_caselist_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='caseinstance',
+            index=models.Index(fields=['User', 'Case', 'Status'], name='caseinstance_user_case_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='answer',
+            index=models.Index(fields=['CaseInstance', 'Question'], name='answer_instance_question_idx'),
+        ),
+    ]
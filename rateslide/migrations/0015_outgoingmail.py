@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rateslide', '0014_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingMail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('MailType', models.CharField(choices=[('invite', 'Invite'), ('welcome', 'Welcome'), ('reminder', 'Reminder')], max_length=10)),
+                ('Created', models.DateTimeField(auto_now_add=True)),
+                ('NextAttempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('Attempts', models.IntegerField(default=0)),
+                ('Sent', models.DateTimeField(blank=True, null=True)),
+                ('Error', models.TextField(blank=True)),
+                ('UserCaseList', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rateslide.usercaselist')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmail',
+            index=models.Index(fields=['Sent', 'NextAttempt'], name='outgoingmail_due_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def mark_anonymous_users(apps, schema_editor):
+    # Anonymous users were recognised by their name
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    AnonymousParticipant = apps.get_model('rateslide', 'AnonymousParticipant')
+    user_ids = User.objects.filter(first_name='Anonymous', last_name='User').values_list('pk', flat=True)
+    AnonymousParticipant.objects.bulk_create([AnonymousParticipant(User_id=user_id) for user_id in user_ids.iterator()],
+                                             batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rateslide', '0015_outgoingmail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnonymousParticipant',
+            fields=[
+                ('User', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(mark_anonymous_users, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:10
+
+from django.db import migrations, models
+
+
+def remove_sketches(apps, schema_editor):
+    # Sketches without a floor may undercount, missing sketches are counted again from the answers
+    apps.get_model('rateslide', 'TextSketch').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rateslide', '0016_anonymousparticipant'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textsketch',
+            name='Floor',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(remove_sketches, migrations.RunPython.noop),
+    ]
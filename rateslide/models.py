@@ -1,24 +1,60 @@
+from collections import defaultdict
 from copy import deepcopy
-from random import choice
 from datetime import datetime, timedelta
+from json import dumps, loads
+from math import floor, log2, sqrt
 
 from django.db import models, transaction
+from django.db.models import Count, F, FilteredRelation, Max, Min, OuterRef, Q, Subquery, Value, When
+from django.db.models import Case as CaseWhen
+from django.db.models.functions import Cast
 from django.contrib.auth.models import User
 from django.conf import settings
-from django.db.models.signals import m2m_changed, post_save
+from django.db.models.signals import m2m_changed, post_save, post_delete
 from django.utils import timezone
 from invitation.models import InvitationKey
 from django_extensions.db.fields import AutoSlugField
 
 from histoslide.models import Slide, SlideAnnotation, SlideBookmark
 
-from .utils import send_usercaselist_mail
+from .caching import bump_version, get_or_build
+
+
+def metadata_cache_timeout():
+    # Seconds caselists and cases are kept in the shared cache, 0 reads them from the database every time
+    return getattr(settings, 'RATESLIDE_METADATA_CACHE_TIMEOUT', 0)
 
 
 def default_enddate():
     # Use datetime 10 years in future
     return timezone.now()+timedelta(days=3650)
 
+def format_evaluation(correct, graded):
+    if graded > 0:
+        return f'{correct} of {graded}'
+    else:
+        return ''
+
+
+class CaseListProgress:
+    """Progress of a single user in a caselist
+
+    completed is the set of case ids the user has completed, it is empty when the progress was computed from counts
+    only.
+    """
+    def __init__(self, case_count, count_completed, count_skipped, count_todo, completed=None):
+        self.case_count = case_count
+        self.count_completed = count_completed
+        self.count_skipped = count_skipped
+        self.count_todo = count_todo
+        self.completed = completed if completed is not None else set()
+
+    @property
+    def count_total(self):
+        # Skipped cases do not count for the user
+        return self.case_count - self.count_skipped
+
+
 class CaseList(models.Model):
     OBSERVER = 'O'
     CASEREPORT = 'C'
@@ -51,6 +87,27 @@ class CaseList(models.Model):
     Users = models.ManyToManyField(User, through='UserCaseList')
     SlideBase = models.CharField(max_length=200, blank=True)
 
+    @staticmethod
+    def get_cached(pk):
+        """Return a caselist from the shared cache, it is invalidated when the caselist is saved or deleted"""
+        timeout = metadata_cache_timeout()
+        if not timeout:
+            return CaseList.objects.get(pk=pk)
+        return get_or_build('caselist', pk, lambda: CaseList.objects.get(pk=pk), timeout)
+
+    @staticmethod
+    def get_cached_by_slug(slug):
+        timeout = metadata_cache_timeout()
+        if not timeout:
+            return CaseList.objects.get(Slug=slug)
+        caselist = CaseList.get_cached(get_or_build('caselistslug', slug, lambda: CaseList.objects.get(Slug=slug).pk,
+                                                    timeout))
+        if caselist.Slug != slug:
+            # The slug of the caselist was changed, the slug may have been given to another caselist
+            bump_version('caselistslug', slug)
+            caselist = CaseList.objects.get(Slug=slug)
+        return caselist
+
     def is_active(self):
         currentdate = datetime.now(timezone.utc)
         return  currentdate > self.StartDate and currentdate < self.EndDate
@@ -60,82 +117,117 @@ class CaseList(models.Model):
         return set(Case.objects.filter(Caselist=self).values_list('pk', flat=True))
 
     def case_count(self):
-        return len(self.cases())
+        return Case.objects.filter(Caselist=self).count()
 
     def user_count(self):
         return UserCaseList.objects.filter(CaseList=self).count()
-    
+
+    def progress(self, user_id):
+        """Return a CaseListProgress for a user, based on a single query
+
+        All cases of the list are joined with the caseinstances of the user, so the counts and the set of completed
+        cases come from the same rows.
+        """
+        rows = Case.objects.filter(Caselist=self).order_by().\
+            annotate(user_instance=FilteredRelation('caseinstance', condition=Q(caseinstance__User=user_id))).\
+            values_list('pk', 'user_instance__Status')
+        cases = set()
+        completed = set()
+        skipped = set()
+        for case_id, status in rows:
+            cases.add(case_id)
+            if status == CaseInstance.ENDED:
+                completed.add(case_id)
+            elif status == CaseInstance.SKIPPED:
+                skipped.add(case_id)
+        # A case can be both skipped and completed, count it once for todo
+        count_todo = len(cases) - len(completed) - len(skipped) + len(completed & skipped)
+        return CaseListProgress(len(cases), len(completed), len(skipped), count_todo, completed)
+
+    def user_progress(self, user_ids):
+        """Return a dict with a CaseListProgress for each user id, counted with one query grouped by User and Status
+
+        The sets of completed cases are not filled, and a case that is both skipped and completed is counted twice.
+        """
+        case_count = self.case_count()
+        counts = defaultdict(dict)
+        rows = CaseInstance.objects.filter(Case__Caselist=self, User__in=user_ids).order_by().\
+            values_list('User', 'Status').annotate(models.Count('Case', distinct=True))
+        for user_id, status, count in rows:
+            counts[user_id][status] = count
+        progress = {}
+        for user_id in user_ids:
+            completed = counts[user_id].get(CaseInstance.ENDED, 0)
+            skipped = counts[user_id].get(CaseInstance.SKIPPED, 0)
+            progress[user_id] = CaseListProgress(case_count, completed, skipped, max(case_count - completed - skipped, 0))
+        return progress
+
+    def attach_user_progress(self, usercaselists):
+        # Assign the progress of a list of UserCaseList rows in bulk
+        progress = self.user_progress([ucl.User_id for ucl in usercaselists])
+        for ucl in usercaselists:
+            ucl._progress = progress[ucl.User_id]
+
     def cases_total(self, user_id):
         return self.cases().difference(self.cases_skipped(user_id))
 
     def case_count_total(self, user_id):
-        return len(self.cases_total(user_id))
+        return self.progress(user_id).count_total
 
     def cases_completed(self, user_id):
         # get a set of case ids that a user has completed
-        user = User.objects.get(pk=user_id)
-        return set(CaseInstance.objects.filter(User=user, Status='E',
-                                               Case__in=self.cases()).values_list('Case', flat=True))
+        return set(CaseInstance.objects.filter(User=user_id, Status=CaseInstance.ENDED,
+                                               Case__Caselist=self).values_list('Case', flat=True))
 
     def case_count_completed(self, user_id):
-        return len(self.cases_completed(user_id))
-    
+        return self.progress(user_id).count_completed
+
     def cases_skipped(self, user_id):
-        # get a set of case ids that a user has completed
-        user = User.objects.get(pk=user_id)
-        return set(CaseInstance.objects.filter(User=user, Status='S',
-                                               Case__in=self.cases()).values_list('Case', flat=True))
+        # get a set of case ids that a user has skipped
+        return set(CaseInstance.objects.filter(User=user_id, Status=CaseInstance.SKIPPED,
+                                               Case__Caselist=self).values_list('Case', flat=True))
 
     def case_count_skipped(self, user_id):
-        return len(self.cases_skipped(user_id))
+        return self.progress(user_id).count_skipped
 
     def cases_todo(self, user_id):
         return self.cases().difference(self.cases_completed(user_id)).difference(self.cases_skipped(user_id))
 
     def get_next_case(self, user_id):
-        # Select a case that has not been scored yet
-        if self.ObserversPerCase == 0:
-            # Select a list of cases with the lowest Order value still to be scored
-            cases = Case.objects.filter(Caselist=self).exclude(caseinstance__User=user_id).order_by('Order')
-            if cases:
-                cases = cases.filter(Order=cases[0].Order)
-                if self.Type == self.OBSERVER:
-                    return choice(list(cases.values_list('pk', flat=True)))
-                else:
-                    return cases[0].pk
-            else:
-                return -1
-        else:
-            # Limit number of assessments per case
-            # count the number of complete caseinstance for each case
-            cases = Case.objects.filter(Caselist=self).\
-                exclude(caseinstance__User=user_id).annotate(models.Count('caseinstance')).\
-                order_by('caseinstance__count')
-            if cases:
-                # Select from the cases that have been assessed least
-                cases = cases.filter(caseinstance__count=cases[0].caseinstance__count)
-                return choice(list(cases.values_list('pk', flat=True)))
-            else:
-                return -1
+        # Select a case that has not been scored yet, -1 when there is none
+        from .assignment import next_case
+        return next_case(self, user_id)
+
+    def ended_answers(self):
+        # Answers of ended caseinstances are evaluated
+        return Answer.objects.filter(CaseInstance__Case__Caselist=self, CaseInstance__Status=CaseInstance.ENDED)
+
+    def grade_counts(self, user_id):
+        return self.ended_answers().filter(CaseInstance__User=user_id).grade_counts()
+
+    def user_grade_counts(self):
+        return self.ended_answers().grade_counts_by_user()
 
     def evaluation(self, user_id):
-        user = User.objects.get(pk=user_id)
-        caseinstances = CaseInstance.objects.filter(User=user, Status='E',
-                                               Case__in=self.cases()).values_list('Case', flat=True)
-        answers = Answer.objects.filter(CaseInstance__in=caseinstances.values('id'))
-        graded_answers = 0
-        correct_answers = 0
-        for answer in answers:
-            grade = answer.grade()
-            if grade == Answer.ERROR or grade == Answer.CORRECT:
-                graded_answers += 1
-                if grade == Answer.CORRECT:
-                    correct_answers += 1
-        if graded_answers > 0:
-            return f'{correct_answers} of {graded_answers}'
-        else:
-            return ''
+        counts = self.grade_counts(user_id)
+        return format_evaluation(counts['correct'], counts['graded'])
+
+    def score(self, user_id):
+        # Read the stored score of a user, see CaseListScore. A missing score is counted, it is stored by submitcase
+        score = CaseListScore.objects.filter(CaseList=self, User=user_id).first()
+        return self.evaluation(user_id) if score is None else score.evaluation()
 
+    def scores(self):
+        # Leaderboard of the stored scores
+        return CaseListScore.objects.filter(CaseList=self).select_related('User').order_by('-Correct', 'Graded')
+
+    @transaction.atomic
+    def rebuild_scores(self):
+        """Regrade all ended answers in this caselist and replace the stored scores"""
+        CaseListScore.objects.filter(CaseList=self).delete()
+        CaseListScore.objects.bulk_create([
+            CaseListScore(User_id=user_id, CaseList=self, Correct=counts['correct'], Graded=counts['graded'])
+            for user_id, counts in self.user_grade_counts().items()])
 
     def __str__(self):
         return self.Name
@@ -151,6 +243,16 @@ class Case(models.Model):
 
     class Meta:
         ordering = ['Order', 'Name']
+        indexes = [models.Index(fields=['Caselist', 'Order'], name='case_caselist_order_idx')]
+
+    @staticmethod
+    def get_cached(pk):
+        """Return a case with its caselist from the shared cache, see CaseList.get_cached"""
+        if not metadata_cache_timeout():
+            return Case.objects.select_related('Caselist').get(pk=pk)
+        case = get_or_build('case', pk, lambda: Case.objects.get(pk=pk), metadata_cache_timeout())
+        case.Caselist = CaseList.get_cached(case.Caselist_id)
+        return case
 
     def __str__(self):
         return self.Name
@@ -186,6 +288,12 @@ class CaseInstance(models.Model):
     Status = models.CharField(max_length=1, choices=status_choices)
     StartTime = models.DateTimeField(auto_now_add=True)
     EndTime = models.DateTimeField(auto_now=True)
+    # Start of the reservation of an OPEN caseinstance, see assignment.reserve_case
+    Reserved = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # Lookups of the caseinstances of a user in a case, the status is read from the index
+        indexes = [models.Index(fields=['User', 'Case', 'Status'], name='caseinstance_user_case_idx')]
 
 
 class Question(models.Model):
@@ -266,6 +374,39 @@ class QuestionItem(models.Model):
         new_questionitem.save()
 
     
+class AnswerQuerySet(models.QuerySet):
+    """Grading in the database, with the same rules as Answer.grade"""
+    graded_filter = ~Q(Question__CorrectAnswer='')
+    correct_filter = graded_filter & (Q(AnswerText=F('Question__CorrectAnswer')) |
+                                      Q(numeric_text=F('Question__CorrectAnswer')))
+
+    def with_numeric_text(self):
+        return self.annotate(numeric_text=Cast('AnswerNumeric', models.CharField()))
+
+    def with_choice_text(self):
+        # Text of the chosen item for multiple choice answers
+        items = QuestionItem.objects.filter(Question=OuterRef('Question'), Order=OuterRef('AnswerNumeric'))
+        return self.annotate(choice_text=Subquery(items.values('Text')[:1]))
+
+    def graded(self):
+        # Annotate each answer with its grade as grade_code
+        return self.with_numeric_text().annotate(grade_code=CaseWhen(
+            When(Question__CorrectAnswer='', then=Value(Answer.NOEVAL)),
+            When(self.correct_filter, then=Value(Answer.CORRECT)),
+            default=Value(Answer.ERROR), output_field=models.CharField()))
+
+    def grade_counts(self):
+        return self.with_numeric_text().aggregate(graded=models.Count('pk', filter=self.graded_filter),
+                                                  correct=models.Count('pk', filter=self.correct_filter))
+
+    def grade_counts_by_user(self):
+        # Return a dict with the grade counts for each user
+        rows = self.with_numeric_text().order_by().values('CaseInstance__User').\
+            annotate(graded=models.Count('pk', filter=self.graded_filter),
+                     correct=models.Count('pk', filter=self.correct_filter))
+        return {row['CaseInstance__User']: {'graded': row['graded'], 'correct': row['correct']} for row in rows}
+
+
 class Answer(models.Model):
     CORRECT = 'C'
     ERROR = 'E'
@@ -276,10 +417,19 @@ class Answer(models.Model):
     AnswerNumeric = models.IntegerField(default=0)
     AnswerText = models.TextField(blank=True)
 
+    objects = AnswerQuerySet.as_manager()
+
+    class Meta:
+        # The answers of a question are found with the index of the Question foreign key
+        indexes = [models.Index(fields=['CaseInstance', 'Question'], name='answer_instance_question_idx')]
+
     def textvalue(self):
         if self.Question.Type == Question.NUMERIC:
             return self.AnswerNumeric
         elif self.Question.Type == Question.MULTIPLECHOICE:
+            if hasattr(self, 'choice_text'):
+                # Annotated by AnswerQuerySet.with_choice_text
+                return self.choice_text or ''
             mc_choice = QuestionItem.objects.filter(Question=self.Question, Order=self.AnswerNumeric)
             if mc_choice.count() == 1:
                 return mc_choice[0].Text
@@ -287,17 +437,20 @@ class Answer(models.Model):
                 return ''
         elif self.Question.Type == Question.LINE:
             if hasattr(self, 'answerannotation'):
-                annotation = loads(answer.answerannotation.AnnotationJSON)
-                return dumps({'length': answer.answerannotation.Length,
-                                                         'length_unit': answer.answerannotation.LengthUnit,
-                                                         'slideid': answer.answerannotation.Slide_id,
-                                                         'annotation': annotation})
+                annotation = loads(self.answerannotation.AnnotationJSON)
+                return dumps({'length': self.answerannotation.Length,
+                              'length_unit': self.answerannotation.LengthUnit,
+                              'slideid': self.answerannotation.Slide_id,
+                              'annotation': annotation})
             else:
                 return ''
         else:
             return self.AnswerText
 
     def grade(self):
+        if hasattr(self, 'grade_code'):
+            # Annotated by AnswerQuerySet.graded
+            return self.grade_code
         if self.Question.CorrectAnswer == '':
             return Answer.NOEVAL
         elif self.Question.CorrectAnswer == self.AnswerText or self.Question.CorrectAnswer == str(self.AnswerNumeric):
@@ -306,7 +459,6 @@ class Answer(models.Model):
             return Answer.ERROR
 
 
-
 class AnswerAnnotation(SlideAnnotation):
     answer = models.OneToOneField(Answer, on_delete=models.CASCADE)
 
@@ -327,29 +479,324 @@ class UserCaseList(models.Model):
     StartTime = models.DateTimeField(auto_now_add=True)
     EndTime = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        unique_together = ('User', 'CaseList')
+
+    def progress(self):
+        # Cache the progress, templates ask for several counts of the same row. It can be assigned in bulk with
+        # CaseList.attach_user_progress
+        if not hasattr(self, '_progress'):
+            self._progress = self.CaseList.progress(self.User_id)
+        return self._progress
+
     def cases_completed(self):
         # get a set of case ids that a user has completed
-        return self.CaseList.cases_completed(self.User.id)
+        return self.progress().completed
 
     def case_count_completed(self):
-        return len(self.cases_completed())
+        return self.progress().count_completed
 
     def cases_todo(self):
-        return self.CaseList.cases_todo(self.User.id)
+        return self.CaseList.cases_todo(self.User_id)
 
     def case_count_todo(self):
-        return len(self.cases_todo())
+        return self.progress().count_todo
 
     def cases_total(self):
-        return self.CaseList.cases_total(self.User.id)
+        return self.CaseList.cases_total(self.User_id)
 
     def case_count_total(self):
-        return len(self.cases_total())
+        return self.progress().count_total
 
     def __str__(self):
         return u'%s %s' % (self.User.username, self.CaseList.Name)
 
 
+class CaseListScore(models.Model):
+    """Stored number of correct and graded answers of a user in an examination caselist
+
+    submitcase adds the difference in grades of a submitted case. After a change of correct answers the scores are
+    rebuilt with the rebuild_scores management command.
+    """
+    User = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    CaseList = models.ForeignKey(CaseList, on_delete=models.CASCADE)
+    Correct = models.IntegerField(default=0)
+    Graded = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('User', 'CaseList')
+
+    def evaluation(self):
+        return format_evaluation(self.Correct, self.Graded)
+
+    @staticmethod
+    def get_score(caselist, user_id):
+        # A missing score is counted from the answers, this also covers answers given before scores were stored
+        score = CaseListScore.objects.filter(CaseList=caselist, User=user_id).first()
+        if score is None:
+            counts = caselist.grade_counts(user_id)
+            score, _ = CaseListScore.objects.get_or_create(User_id=user_id, CaseList=caselist,
+                                                           defaults={'Correct': counts['correct'],
+                                                                     'Graded': counts['graded']})
+        return score
+
+    @staticmethod
+    def add(user_id, caselist, correct, graded):
+        # Add to the score in the database, so concurrent submissions are not lost
+        updated = CaseListScore.objects.filter(CaseList=caselist, User=user_id).\
+            update(Correct=F('Correct') + correct, Graded=F('Graded') + graded)
+        if not updated:
+            CaseListScore.get_score(caselist, user_id)
+
+    def __str__(self):
+        return u'%s %s %s' % (self.User.username, self.CaseList.Name, self.evaluation())
+
+
+LENGTH_BINS_PER_OCTAVE = 8
+
+
+def length_bin(length):
+    # Logarithmic bins for the sketch of line lengths
+    return floor(log2(max(length, 1e-6)) * LENGTH_BINS_PER_OCTAVE)
+
+
+def length_bin_center(length_bin):
+    return 2 ** ((length_bin + 0.5) / LENGTH_BINS_PER_OCTAVE)
+
+
+# Question types that have running statistics
+STATISTICS_QUESTION_TYPES = (Question.NUMERIC, Question.MULTIPLECHOICE, Question.LINE)
+
+
+class QuestionStatistics(models.Model):
+    """Running statistics of the answers to a numeric, multiple choice or line question
+
+    The mean and the sum of squared deviations from the mean are updated with Welford's method when submitcase adds,
+    changes or removes answers. Counts holds the number of answers per value, per choice or, for lines, per
+    logarithmic bin of the length. Missing statistics are computed from the answers.
+    Answers that are changed or deleted in another way, through the admin, by deleting cases, questions or users, or
+    by purging anonymous users, leave the statistics stale until the rebuild_question_statistics management command
+    is run.
+    """
+    Question = models.OneToOneField(Question, on_delete=models.CASCADE)
+    Count = models.IntegerField(default=0)
+    Mean = models.FloatField(default=0)
+    SumSquares = models.FloatField(default=0)
+    Min = models.FloatField(null=True)
+    Max = models.FloatField(null=True)
+    Counts = models.TextField(default='{}')
+
+    QUESTION_TYPES = STATISTICS_QUESTION_TYPES
+
+    def sd(self):
+        return sqrt(self.SumSquares / (self.Count - 1)) if self.Count > 1 else None
+
+    def value_counts(self):
+        # Counts with integer keys, values or choices or length bins
+        return {int(key): count for key, count in loads(self.Counts).items()}
+
+    def apply(self, question_type, removed, added):
+        counts = self.value_counts()
+        for value in removed:
+            key = length_bin(value) if question_type == Question.LINE else int(value)
+            if counts.get(key, 0) <= 1:
+                counts.pop(key, None)
+            else:
+                counts[key] -= 1
+            if self.Count <= 1:
+                self.Count, self.Mean, self.SumSquares = 0, 0.0, 0.0
+            else:
+                self.Count -= 1
+                delta = value - self.Mean
+                self.Mean -= delta / self.Count
+                self.SumSquares = max(self.SumSquares - delta * (value - self.Mean), 0.0)
+        for value in added:
+            key = length_bin(value) if question_type == Question.LINE else int(value)
+            counts[key] = counts.get(key, 0) + 1
+            self.Count += 1
+            delta = value - self.Mean
+            self.Mean += delta / self.Count
+            self.SumSquares += delta * (value - self.Mean)
+            self.Min = value if self.Min is None else min(self.Min, value)
+            self.Max = value if self.Max is None else max(self.Max, value)
+        if self.Count == 0:
+            self.Min = self.Max = None
+        elif any(value <= self.Min or value >= self.Max for value in removed):
+            # An extreme was removed, the counts of values are exact, the bins of lengths are not
+            if question_type == Question.LINE:
+                extremes = AnswerAnnotation.objects.filter(answer__Question=self.Question_id).\
+                    aggregate(Min('Length'), Max('Length'))
+                self.Min, self.Max = extremes['Length__min'], extremes['Length__max']
+            else:
+                self.Min, self.Max = min(counts), max(counts)
+        self.Counts = dumps({str(key): count for key, count in counts.items()})
+
+    @staticmethod
+    def answer_values(question_id, question_type):
+        if question_type == Question.LINE:
+            return list(AnswerAnnotation.objects.filter(answer__Question=question_id).
+                        values_list('Length', flat=True))
+        else:
+            return list(Answer.objects.filter(Question=question_id).values_list('AnswerNumeric', flat=True))
+
+    @staticmethod
+    def rebuild(question_id, question_type):
+        # Compute the statistics of a question from all its answers
+        statistics = QuestionStatistics(Question_id=question_id)
+        statistics.apply(question_type, [], QuestionStatistics.answer_values(question_id, question_type))
+        return QuestionStatistics.objects.update_or_create(
+            Question_id=question_id,
+            defaults={field: getattr(statistics, field)
+                      for field in ('Count', 'Mean', 'SumSquares', 'Min', 'Max', 'Counts')})[0]
+
+    @staticmethod
+    def get_statistics(question_types):
+        """Return the statistics of questions, a dict of question id to type, missing statistics are computed"""
+        statistics = {statistic.Question_id: statistic for statistic in
+                      QuestionStatistics.objects.filter(Question__in=question_types.keys())}
+        for question_id, question_type in question_types.items():
+            if question_id not in statistics:
+                statistics[question_id] = QuestionStatistics.rebuild(question_id, question_type)
+        return statistics
+
+    @staticmethod
+    def update(changes):
+        """Apply changed answers that have been saved already
+
+        changes is a dict of question id to a tuple of question type, removed values and added values. Only the
+        statistics of the changed questions are locked, in question order, within the transaction that saved the
+        answers, so concurrent submissions are not lost and the statistics commit or roll back with the answers.
+        """
+        changes = {question_id: change for question_id, change in changes.items()
+                   if change[0] in QuestionStatistics.QUESTION_TYPES and (change[1] or change[2])}
+        with transaction.atomic():
+            statistics = {statistic.Question_id: statistic for statistic in
+                          QuestionStatistics.objects.select_for_update().
+                          filter(Question__in=changes.keys()).order_by('Question_id')}
+            for question_id, (question_type, removed, added) in changes.items():
+                if question_id in statistics:
+                    statistics[question_id].apply(question_type, removed, added)
+                    statistics[question_id].save()
+                else:
+                    # Computed from the answers, which include the changes
+                    QuestionStatistics.rebuild(question_id, question_type)
+
+    @staticmethod
+    def answer_removals(answers):
+        """The values of answers that are deleted as changes for update and TextSketch.update
+
+        Line answers without a measurement and empty texts are left out.
+        """
+        changes = {}
+        for question_id, question_type, numeric, text, length in answers.order_by().\
+                values_list('Question', 'Question__Type', 'AnswerNumeric', 'AnswerText', 'answerannotation__Length'):
+            if question_type == Question.LINE:
+                value = length
+            elif question_type == Question.OPENTEXT:
+                value = text or None
+            else:
+                value = numeric
+            if value is not None:
+                changes.setdefault(question_id, (question_type, [], []))[1].append(value)
+        return changes
+
+    def __str__(self):
+        return u'%s %d' % (self.Question.Text, self.Count)
+
+
+def text_sketch_size():
+    # Number of texts kept in the sketch of an open text question, 0 counts the answers exactly in the report
+    return getattr(settings, 'RATESLIDE_TEXT_SKETCH_SIZE', 0)
+
+
+class TextSketch(models.Model):
+    """Space-Saving sketch of the most common answers to an open text question
+
+    Items maps a text to its count and the maximum overcount of that count. A text that is not in the sketch has
+    been given at most Floor times, the highest count of a text that was replaced or left out, so a text that
+    enters the sketch starts from Floor. submitcase adds and removes the answers, removals of texts that are not in
+    the sketch are lost, the rebuild_question_statistics command counts them exactly again.
+    """
+    Question = models.OneToOneField(Question, on_delete=models.CASCADE)
+    Total = models.IntegerField(default=0)
+    Items = models.TextField(default='{}')
+    Floor = models.IntegerField(default=0)
+
+    def apply(self, removed, added, size):
+        items = loads(self.Items)
+        for text in removed:
+            self.Total -= 1
+            if text in items:
+                count, error = items[text]
+                if count <= 1:
+                    del items[text]
+                else:
+                    items[text] = [count - 1, min(error, count - 1)]
+        for text in added:
+            self.Total += 1
+            if text in items:
+                items[text][0] += 1
+            else:
+                if len(items) >= size:
+                    # The least counted text is replaced, the new text may have been one of its answers
+                    least = min(items, key=lambda key: items[key][0])
+                    self.Floor = max(self.Floor, items.pop(least)[0])
+                # A slot freed by removals does not forget earlier replacements
+                items[text] = [self.Floor + 1, self.Floor]
+        self.Items = dumps(items)
+
+    def top(self, count=10):
+        # The most common texts with their count and maximum overcount
+        items = sorted(loads(self.Items).items(), key=lambda item: (-item[1][0], item[0]))
+        return [(text, n, error) for text, (n, error) in items[:count]]
+
+    @staticmethod
+    def rebuild(question_id, size):
+        # Exact counts of the most common texts, every text left out is counted at most as often as the next one
+        answers = Answer.objects.filter(Question=question_id).exclude(AnswerText='').order_by()
+        items = list(answers.values('AnswerText').annotate(n=Count('pk')).order_by('-n', 'AnswerText').
+                     values_list('AnswerText', 'n')[:size + 1])
+        floor = items.pop()[1] if len(items) > size else 0
+        return TextSketch.objects.update_or_create(
+            Question_id=question_id,
+            defaults={'Total': answers.count(), 'Items': dumps({text: [n, 0] for text, n in items}),
+                      'Floor': floor})[0]
+
+    @staticmethod
+    def get_sketches(question_ids):
+        # Missing sketches are counted from the answers
+        sketches = {sketch.Question_id: sketch for sketch in TextSketch.objects.filter(Question__in=question_ids)}
+        for question_id in question_ids:
+            if question_id not in sketches:
+                sketches[question_id] = TextSketch.rebuild(question_id, text_sketch_size())
+        return sketches
+
+    @staticmethod
+    def update(changes):
+        """Apply changed open text answers that have been saved already, changes as for QuestionStatistics.update
+
+        Nothing is done when the sketches are disabled.
+        """
+        size = text_sketch_size()
+        changes = {question_id: change for question_id, change in changes.items()
+                   if change[0] == Question.OPENTEXT and (change[1] or change[2])}
+        if not size or not changes:
+            return
+        with transaction.atomic():
+            sketches = {sketch.Question_id: sketch for sketch in
+                        TextSketch.objects.select_for_update().filter(Question__in=changes.keys()).
+                        order_by('Question_id')}
+            for question_id, (_, removed, added) in changes.items():
+                if question_id in sketches:
+                    sketches[question_id].apply(removed, added, size)
+                    sketches[question_id].save()
+                else:
+                    TextSketch.rebuild(question_id, size)
+
+    def __str__(self):
+        return u'%s %d' % (self.Question.Text, self.Total)
+
+
 class CaseSlide(models.Model):
     Case = models.ForeignKey(Case, on_delete=models.CASCADE)
     Slide = models.ForeignKey(Slide, on_delete=models.CASCADE)
@@ -376,10 +823,47 @@ class CaseListInvitation(models.Model):
     Invitation = models.ForeignKey(InvitationKey, on_delete=models.CASCADE)
 
 
+class AnonymousParticipant(models.Model):
+    """Marks a user that was created for an anonymous visitor of a caselist that is visible for non users"""
+    User = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True)
+
+    def __str__(self):
+        return u'%s' % self.User_id
+
+
+class OutgoingMail(models.Model):
+    """Mail to a member of a caselist in the outbox, see mail.send_outbox
+
+    Attempts counts the deliveries that were started, a failed mail is tried again from NextAttempt on.
+    """
+    INVITE = 'invite'
+    WELCOME = 'welcome'
+    REMINDER = 'reminder'
+    mail_type_choices = (
+        (INVITE, 'Invite'),
+        (WELCOME, 'Welcome'),
+        (REMINDER, 'Reminder'),
+    )
+    UserCaseList = models.ForeignKey(UserCaseList, on_delete=models.CASCADE)
+    MailType = models.CharField(max_length=10, choices=mail_type_choices)
+    Created = models.DateTimeField(auto_now_add=True)
+    NextAttempt = models.DateTimeField(default=timezone.now)
+    Attempts = models.IntegerField(default=0)
+    Sent = models.DateTimeField(null=True, blank=True)
+    Error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['Sent', 'NextAttempt'], name='outgoingmail_due_idx')]
+
+    def __str__(self):
+        return u'%s %s' % (self.MailType, self.UserCaseList_id)
+
+
 def registrant_m2m_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
     """Connect to caselist When a registration is made using this key.
     """
     # Check registrant against caselists
+    from .mail import queue_mail
     if action == "post_add":
         newusers = User.objects.filter(pk__in=pk_set)
         for newuser in newusers:
@@ -387,7 +871,7 @@ def registrant_m2m_changed(sender, instance, action, reverse, model, pk_set, **k
             for caselistinvitation in caselistinvitations:
                 ucl, created = UserCaseList.objects.get_or_create(User=newuser, CaseList=caselistinvitation.Caselist,
                                                                   defaults={'Status': UserCaseList.ACTIVE})
-                send_usercaselist_mail(ucl, 'welcome')
+                queue_mail([ucl.pk], OutgoingMail.WELCOME)
 
 
 m2m_changed.connect(registrant_m2m_changed, sender=InvitationKey.registrant.through)
@@ -401,3 +885,35 @@ def caselist_post_save(sender, instance, created, raw, using, **kwargs):
                                                                   defaults={'Status': UserCaseList.ACTIVE})
 
 post_save.connect(caselist_post_save, sender=CaseList)
+
+
+def caselist_metadata_changed(sender, instance, **kwargs):
+    """ Invalidate the cached caselist or case, see CaseList.get_cached and Case.get_cached
+    """
+    if sender == CaseList:
+        bump_version('caselist', instance.pk)
+        bump_version('caselistslug', instance.Slug)
+    else:
+        bump_version('case', instance.pk)
+
+
+for metadata_model in (CaseList, Case):
+    post_save.connect(caselist_metadata_changed, sender=metadata_model)
+    post_delete.connect(caselist_metadata_changed, sender=metadata_model)
+
+
+def question_schema_changed(sender, instance, **kwargs):
+    """ Invalidate the cached form schema of the case of a question, see forms.question_schema
+    """
+    if sender == Question:
+        case_id = instance.Case_id
+    else:
+        # The question can be gone already when items are deleted along with it, its own signal covers that
+        case_id = Question.objects.filter(pk=instance.Question_id).values_list('Case', flat=True).first()
+    if case_id is not None:
+        bump_version('questionschema', case_id)
+
+
+for schema_model in (Question, QuestionItem, QuestionBookmark):
+    post_save.connect(question_schema_changed, sender=schema_model)
+    post_delete.connect(question_schema_changed, sender=schema_model)
@@ -0,0 +1,239 @@
+# Rateslide reports
+#
+# The plotting libraries are imported by this module only, so processes that never show a report do not load them.
+# Histograms are stored in MEDIA_ROOT under a name derived from their data and reused while the data is the same.
+# The histograms of earlier data of a question are removed once no report used them for HISTOGRAM_MAX_AGE seconds.
+#
+from json import dumps, loads
+from os import path, makedirs, remove, replace, stat, utime
+from glob import glob
+from hashlib import sha1
+from collections import defaultdict
+from tempfile import NamedTemporaryFile
+from time import sleep, time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+import numpy as np
+from matplotlib import cm
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import Normalize, to_hex
+from matplotlib.figure import Figure
+
+from .models import Answer, AnswerAnnotation, Question, QuestionItem, QuestionStatistics, TextSketch, \
+                   length_bin_center, text_sketch_size
+
+HISTOGRAM_DIR = 'questionresult'
+HISTOGRAM_LOCK_TIMEOUT = 30
+HISTOGRAM_POLL_INTERVAL = 0.1
+HISTOGRAM_MAX_AGE = 3600
+
+
+def histogram_name(x, question_id):
+    # The name contains a hash of the data, so an unchanged histogram is found on disk
+    digest = sha1(str(x.dtype).encode() + x.tobytes()).hexdigest()[:20]
+    return '{0}/hist_{1:d}_{2}.png'.format(HISTOGRAM_DIR, question_id, digest)
+
+
+def render_histogram(x, filename):
+    # A Figure without pyplot is not kept in global state, it is released when it goes out of scope
+    fig = Figure(figsize=(3, 1))
+    FigureCanvasAgg(fig)
+    axs = fig.subplots()
+    n, bins, patches = axs.hist(x)
+    for i, patch in enumerate(patches):
+        color = cm.viridis(i/(len(patches)-1))
+        patch.set_facecolor(color)
+    # Write to a temporary file first, so a partial image is never served
+    tmp = NamedTemporaryFile(dir=path.dirname(filename), suffix='.png', delete=False)
+    try:
+        with tmp:
+            fig.savefig(tmp, format='png', dpi=100, bbox_inches='tight')
+        replace(tmp.name, filename)
+    finally:
+        if path.exists(tmp.name):
+            remove(tmp.name)
+        fig.clear()
+
+
+def remove_old_histograms(question_id, filename):
+    # Histograms of earlier data may still be shown by reports that were rendered recently
+    deadline = time() - HISTOGRAM_MAX_AGE
+    for old_file in glob(path.join(path.dirname(filename), 'hist_{0:d}_*.png'.format(question_id))):
+        try:
+            if old_file != filename and stat(old_file).st_mtime < deadline:
+                remove(old_file)
+        except OSError:
+            pass
+
+
+def generate_report_histogram(data, question_id):
+    """Return the url of a histogram of data, the image is only rendered when the data has changed
+
+    The lock only saves work when reports share a cache. A report that finds the image being rendered elsewhere
+    waits for the file to appear, and takes over the lock when the other report gave up. It renders without the lock
+    only when the file is still missing after HISTOGRAM_LOCK_TIMEOUT seconds. The modification time of an image that
+    is reused is updated, so it is not removed as an old histogram while it is in use.
+    """
+    x = np.asarray(data)
+    fname = histogram_name(x, question_id)
+    filename = path.join(settings.MEDIA_ROOT, fname)
+    try:
+        utime(filename)
+        return settings.MEDIA_URL + fname
+    except FileNotFoundError:
+        pass
+    makedirs(path.dirname(filename), exist_ok=True)
+    lock = 'rateslide:histogram:' + fname
+    deadline = time() + HISTOGRAM_LOCK_TIMEOUT
+    while not cache.add(lock, True, HISTOGRAM_LOCK_TIMEOUT):
+        if path.exists(filename):
+            return settings.MEDIA_URL + fname
+        if time() >= deadline:
+            render_histogram(x, filename)
+            return settings.MEDIA_URL + fname
+        sleep(HISTOGRAM_POLL_INTERVAL)
+    try:
+        # Rendered by the report that held the lock before
+        if not path.exists(filename):
+            render_histogram(x, filename)
+            remove_old_histograms(question_id, filename)
+    finally:
+        cache.delete(lock)
+    return settings.MEDIA_URL + fname
+
+
+def histogram_data(data):
+    """Return the bins of a histogram of data with their viridis colours, for drawing in the browser"""
+    counts, edges = np.histogram(np.asarray(data))
+    colors = [to_hex(cm.viridis(i/(len(counts)-1))) for i in range(len(counts))]
+    return {'counts': counts.tolist(), 'edges': edges.tolist(), 'colors': colors}
+
+
+def histogram_mode():
+    # 'png' renders images in MEDIA_ROOT, 'svg' leaves drawing to the browser
+    return getattr(settings, 'RATESLIDE_REPORT_HISTOGRAMS', 'png')
+
+
+def add_histogram(question, data, mode):
+    if mode == 'svg':
+        question['histogram'] = dumps(histogram_data(data))
+    else:
+        question['resultimage'] = generate_report_histogram(data, question['id'])
+
+
+def color_annotations_by(annotations, data):
+    x = np.asarray(data)
+    norm = Normalize(x.min(), x.max())
+    for i, annot in enumerate(annotations):
+        color = cm.viridis(norm(x[i]))
+        annot['annotation'][1]['stroke'] = to_hex(color)
+
+
+def numeric_summary(statistics, unit=None):
+    # min, max, mean and sample standard deviation from the running statistics of a question
+    sd = statistics.sd()
+    values = [statistics.Min, statistics.Max, statistics.Mean, sd if sd is not None else '-']
+    if unit is not None:
+        values = ['{0:.2g} {1:s}'.format(value, unit) if value != '-' else value for value in values]
+    return [tuple(values)]
+
+
+def statistics_histogram_values(statistics, question_type):
+    # The answers as counted in the statistics, lengths are represented by the centre of their bin
+    counts = statistics.value_counts()
+    keys = sorted(counts)
+    values = [length_bin_center(key) for key in keys] if question_type == Question.LINE else keys
+    return np.repeat(np.asarray(values), [counts[key] for key in keys])
+
+
+def case_report_questions(cs, mode=None):
+    """Return the questions of a case with the summary of their answers
+
+    Numeric, multiple choice and line questions are summarised from their running statistics, open text questions
+    from their sketch when enabled, other answers are counted with a few grouped queries for the whole case, in
+    stead of several queries per question. mode selects how histograms are delivered, see histogram_mode
+    """
+    if mode is None:
+        mode = histogram_mode()
+    questions = list(Question.objects.filter(Case=cs).values())
+    answers = Answer.objects.filter(Question__Case=cs).order_by()
+
+    # Number of answers per question, open text only counts answers that are not empty
+    totals = {row['Question']: row for row in answers.filter(Question__Type__in=[Question.DATE, Question.OPENTEXT]).
+              values('Question').annotate(total=Count('pk'), nonempty=Count('pk', filter=~Q(AnswerText='')))}
+    statistics = QuestionStatistics.get_statistics({question['id']: question['Type'] for question in questions
+                                                    if question['Type'] in QuestionStatistics.QUESTION_TYPES})
+    sketches = {}
+    if text_sketch_size():
+        sketches = TextSketch.get_sketches([question['id'] for question in questions
+                                            if question['Type'] == Question.OPENTEXT])
+    choices = defaultdict(list)
+    for question_id, order, text in QuestionItem.objects.filter(Question__Case=cs).\
+            order_by('Question', 'Order').values_list('Question', 'Order', 'Text'):
+        choices[question_id].append((order, text))
+    # Measured lines, they are drawn on the slides
+    lines = defaultdict(list)
+    for line in AnswerAnnotation.objects.filter(answer__Question__Case=cs).order_by('answer').\
+            values('answer', 'answer__Question', 'Length', 'LengthUnit', 'Slide', 'AnnotationJSON'):
+        lines[line['answer__Question']].append(line)
+
+    for question in questions:
+        counts = totals.get(question['id'], {'total': 0, 'nonempty': 0})
+        if question['Type'] == Question.NUMERIC:
+            question_statistics = statistics[question['id']]
+            question['total_answers'] = question_statistics.Count
+            if question_statistics.Count > 0:
+                add_histogram(question, statistics_histogram_values(question_statistics, Question.NUMERIC), mode)
+                question['headings'] = ['min', 'max', 'avg', 'sd']
+                question['data'] = numeric_summary(question_statistics)
+        elif question['Type'] == Question.MULTIPLECHOICE:
+            question_statistics = statistics[question['id']]
+            question['total_answers'] = question_statistics.Count
+            if question_statistics.Count > 0:
+                question['headings'] = ['n', '%', 'choice']
+                counter = question_statistics.value_counts()
+                question['data'] = [(counter.get(k, 0), "{0:.0%}".format(counter.get(k, 0)/question_statistics.Count),
+                                     n) for (k, n) in choices[question['id']]]
+        elif question['Type'] == Question.DATE:
+            question['total_answers'] = counts['total']
+        elif question['Type'] == Question.LINE:
+            question_lines = lines[question['id']]
+            question['total_answers'] = len(question_lines)
+            if question_lines:
+                lengths = np.asarray([line['Length'] for line in question_lines])
+                annots = []
+                for line in question_lines:
+                    annot = loads(line['AnnotationJSON'])
+                    annot.append(str(line['answer']))
+                    annots.append({'slideid': line['Slide'], 'annotation': annot})
+                lengthunit = set(line['LengthUnit'] for line in question_lines)
+                lengthunit = lengthunit.pop() if len(lengthunit) == 1 else '-'
+                add_histogram(question, statistics_histogram_values(statistics[question['id']], Question.LINE), mode)
+                color_annotations_by(annots, lengths)
+                question['headings'] = ['min', 'max', 'avg', 'sd']
+                question['data'] = numeric_summary(statistics[question['id']], lengthunit)
+                question['annotations'] = dumps(annots)
+        elif question['id'] in sketches:  # OpenText counted by a sketch
+            total = sketches[question['id']].Total
+            question['total_answers'] = total
+            if total > 0:
+                question['headings'] = ['n', '%', 'text', 'max. overcount']
+                question['data'] = [(n, "{0:.0%}".format(n/total), t, e)
+                                    for (t, n, e) in sketches[question['id']].top()]
+        else:  # OpenText
+            question['total_answers'] = counts['nonempty']
+            if counts['nonempty'] > 0:
+                question['headings'] = ['n', '%', 'text']
+                question['data'] = [(n, "{0:.0%}".format(n/counts['nonempty']), t, )
+                                    for (t, n) in top_texts(question['id'])]
+    return questions
+
+
+def top_texts(question_id, count=10):
+    # The most common open text answers, counted by the database
+    return Answer.objects.filter(Question=question_id).exclude(AnswerText='').order_by().\
+        values('AnswerText').annotate(n=Count('pk')).order_by('-n', 'AnswerText').\
+        values_list('AnswerText', 'n')[:count]
@@ -180,7 +180,46 @@ function initialize_case() {
     }
 };
 
+function draw_histogram(element, histogram) {
+    // Draw the bins of a histogram as an inline svg of 300x100 pixels
+    var svgns = "http://www.w3.org/2000/svg";
+    var width = 300, height = 100, axis = 14;
+    var svg = document.createElementNS(svgns, "svg");
+    svg.setAttribute("width", width);
+    svg.setAttribute("height", height);
+    var maxcount = Math.max.apply(null, histogram.counts);
+    var barwidth = width / histogram.counts.length;
+    for (index = 0; index < histogram.counts.length; index += 1) {
+        var barheight = maxcount > 0 ? (height - axis) * histogram.counts[index] / maxcount : 0;
+        var bar = document.createElementNS(svgns, "rect");
+        bar.setAttribute("x", index * barwidth);
+        bar.setAttribute("y", height - axis - barheight);
+        bar.setAttribute("width", barwidth - 1);
+        bar.setAttribute("height", barheight);
+        bar.setAttribute("fill", histogram.colors[index]);
+        var title = document.createElementNS(svgns, "title");
+        title.textContent = histogram.edges[index].toPrecision(3) + " - " +
+                            histogram.edges[index + 1].toPrecision(3) + ": " + histogram.counts[index];
+        bar.appendChild(title);
+        svg.appendChild(bar);
+    }
+    var labels = [[histogram.edges[0], 0, "start"], [histogram.edges[histogram.edges.length - 1], width, "end"]];
+    for (index = 0; index < labels.length; index += 1) {
+        var label = document.createElementNS(svgns, "text");
+        label.setAttribute("x", labels[index][1]);
+        label.setAttribute("y", height - 2);
+        label.setAttribute("font-size", "10");
+        label.setAttribute("text-anchor", labels[index][2]);
+        label.textContent = labels[index][0].toPrecision(3);
+        svg.appendChild(label);
+    }
+    element.appendChild(svg);
+};
+
 function initialize_report() {
+    $('.histogram').each(function() {
+        draw_histogram(this, $(this).data('histogram'));
+    });
     if (!annotations) {
         annotations = new OpenSeadragon.Annotations({"viewer":viewer});
         annotations.EnableControls(false);
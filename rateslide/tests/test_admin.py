@@ -1,6 +1,10 @@
-from django.test import TestCase
+from unittest import mock
+
+from django.test import TestCase, RequestFactory
 from django.contrib.auth.models import User
 from django.contrib.admin.sites import AdminSite
+from django.contrib.messages import get_messages
+from django.contrib.messages.storage.cookie import CookieStorage
 
 from rateslide.admin import NewUserAdmin
 from rateslide.utils import create_anonymous_user
@@ -10,11 +14,17 @@ from rateslide.models import UserCaseList, CaseInstance, CaseList, Case, Answer,
 class UserAdminTests(TestCase):
     fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
 
+    def delete_inactive_anonymous_users(self, queryset=None):
+        request = RequestFactory().post('/')
+        request._messages = CookieStorage(request)
+        ua = NewUserAdmin(User, AdminSite)
+        ua.delete_inactive_anonymous_users(request, User.objects.all() if queryset is None else queryset)
+        return [str(message) for message in get_messages(request)]
+
     def test_DoNotDeleteNonAnonymous(self):
         users = User.objects.all()
         usercount = users.count()
-        ua = NewUserAdmin(User, AdminSite)
-        ua.delete_inactive_anonymous_users(1, 1)
+        self.delete_inactive_anonymous_users()
 
         users = User.objects.all()
         self.assertEqual(usercount, users.count(), 'No users should be deleted')
@@ -24,8 +34,7 @@ class UserAdminTests(TestCase):
         users = User.objects.all()
         usercount = users.count()
 
-        ua = NewUserAdmin(User, AdminSite)
-        ua.delete_inactive_anonymous_users(1, 1)
+        self.delete_inactive_anonymous_users()
 
         users = User.objects.all()
         self.assertEqual(usercount - 1, users.count(), 'One user should be deleted')
@@ -45,8 +54,7 @@ class UserAdminTests(TestCase):
         question = Question.objects.get(pk=1)
         Answer.objects.create(CaseInstance=ci, Question=question, AnswerNumeric=2)
 
-        ua = NewUserAdmin(User, AdminSite)
-        ua.delete_inactive_anonymous_users(1, 1)
+        self.delete_inactive_anonymous_users()
 
         users = User.objects.all()
         self.assertEqual(usercount, users.count(), 'This user should not be deleted')
@@ -61,10 +69,25 @@ class UserAdminTests(TestCase):
         # add user to caselist
         UserCaseList.objects.create(User=anon1, CaseList=cl, Status=UserCaseList.ACTIVE)
 
-        ua = NewUserAdmin(User, AdminSite)
-        ua.delete_inactive_anonymous_users(1, 1)
+        self.delete_inactive_anonymous_users()
 
         users = User.objects.all()
         self.assertEqual(usercount - 1, users.count(), 'One user should be deleted')
         users = User.objects.filter(username=anon1.username)
         self.assertEqual(0, users.count(), 'Created user should not be in user list')
+
+    def test_DeleteSelectedAnonymousUsers(self):
+        anon1 = create_anonymous_user()
+        anon2 = create_anonymous_user()
+        messages = self.delete_inactive_anonymous_users(User.objects.filter(pk=anon1.pk))
+        self.assertFalse(User.objects.filter(pk=anon1.pk).exists())
+        self.assertTrue(User.objects.filter(pk=anon2.pk).exists(), 'User was not selected')
+        self.assertEqual(messages, ['1 inactive anonymous users were deleted.'])
+
+    def test_DeleteAnonymousUsersInOneBatch(self):
+        anon1 = create_anonymous_user()
+        anon2 = create_anonymous_user()
+        with mock.patch('rateslide.admin.PURGE_BATCH_SIZE', 1):
+            messages = self.delete_inactive_anonymous_users()
+        self.assertEqual(User.objects.filter(pk__in=[anon1.pk, anon2.pk]).count(), 1)
+        self.assertIn('purge_anonymous_users', messages[0])
@@ -0,0 +1,95 @@
+from io import BytesIO
+
+import numpy as np
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.contrib.auth.models import User
+
+from rateslide import analysis
+from rateslide.caching import bump_version
+from rateslide.models import Answer, CaseInstance, CaseList
+
+
+class ObserverMatrixTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def test_observer_matrix(self):
+        cl = CaseList.objects.get(pk=1)
+        user = User.objects.get(username='user')
+        ci = CaseInstance.objects.create(Case_id=4, User=user, Status=CaseInstance.ENDED)
+        Answer.objects.create(CaseInstance=ci, Question_id=4, AnswerNumeric=3)
+        matrix = analysis.observer_matrix(cl)
+        self.assertEqual(list(matrix['observers']), [1, 2])
+        self.assertEqual(list(matrix['cases']), [1, 3, 4, 5, 6])
+        self.assertEqual(list(matrix['questions']), [1, 1], 'Order 1 is multiple choice and numeric')
+        self.assertEqual(list(matrix['question_types']), ['M', 'N'])
+        self.assertEqual(matrix['values'].shape, (2, 5, 2))
+        self.assertEqual(matrix['values'][0, 0, 0], 2, 'answer of admin to case 1')
+        self.assertEqual(matrix['values'][1, 2, 0], 3, 'answer of user to case 4')
+        self.assertEqual(matrix['missing'].sum(), 18)
+
+    def test_caselistmatrix_download(self):
+        url = reverse('rateslide:caselistmatrix', kwargs={'slug': 'simple-case'})
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        matrix = np.load(BytesIO(response.content))
+        self.assertEqual(matrix['values'].shape, (1, 5, 2))
+
+
+class AgreementTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def test_fleiss_kappa(self):
+        # Fleiss (1971) style example: perfect agreement and agreement at chance level
+        self.assertEqual(analysis.fleiss_kappa(np.array([[2, 0], [0, 2]])), 1.0)
+        self.assertAlmostEqual(analysis.fleiss_kappa(np.array([[1, 1], [1, 1]])), -1.0)
+        self.assertIsNone(analysis.fleiss_kappa(np.array([[1, 0], [0, 1]])), 'no case with two ratings')
+
+    def test_choice_agreement(self):
+        values = np.array([[1, 2, 1, 2], [1, 2, 1, 1], [1, 2, 0, 0]], dtype=float)
+        missing = np.array([[False] * 4, [False] * 4, [False, False, True, True]])
+        agreement = analysis.choice_agreement(values, missing)
+        self.assertEqual(agreement['cases'], 4)
+        self.assertEqual([observer['cases'] for observer in agreement['observers']], [4, 4, 2])
+        self.assertEqual(agreement['observers'][2]['deviation'], 0.0)
+        self.assertEqual(agreement['observers'][2]['kappa'], 1.0)
+
+    def test_measurement_agreement(self):
+        values = np.array([[1, 2, 3, 4], [2, 3, 4, 5]], dtype=float)
+        missing = np.zeros(values.shape, dtype=bool)
+        agreement = analysis.measurement_agreement(values, missing)
+        self.assertEqual(agreement['observers'][0]['bias'], -1.0)
+        self.assertEqual(agreement['observers'][1]['bias'], 1.0)
+        self.assertEqual(agreement['observers'][1]['lower'], 1.0, 'constant difference')
+        self.assertAlmostEqual(agreement['value'], 17 / 23)
+        values[1] = values[0]
+        self.assertEqual(analysis.measurement_agreement(values, missing)['value'], 1.0)
+
+    def test_agreement_report_cache(self):
+        cache.clear()
+        cl = CaseList.objects.get(pk=1)
+        report = analysis.cached_agreement_report(cl)['questions']
+        self.assertEqual([(question['order'], question['type']) for question in report], [(1, 'M'), (1, 'N')])
+        self.assertEqual([question['statistic'] for question in report], ["Fleiss' kappa", 'ICC(1)'])
+        self.assertEqual(report[0]['observers'], [], 'a single observer is not compared')
+        with self.assertNumQueries(0):
+            analysis.cached_agreement_report(cl)
+
+    def test_agreement_report_interval(self):
+        cache.clear()
+        cl = CaseList.objects.get(pk=1)
+        computed = analysis.cached_agreement_report(cl)['computed']
+        bump_version('agreement', cl.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(analysis.cached_agreement_report(cl)['computed'], computed, 'changed within interval')
+        with override_settings(RATESLIDE_AGREEMENT_INTERVAL=0):
+            self.assertNotEqual(analysis.cached_agreement_report(cl)['computed'], computed)
+
+    def test_caselistreport_agreement(self):
+        url = reverse('rateslide:caselistreport', kwargs={'slug': 'simple-case'})
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(url)
+        self.assertContains(response, 'Agreement')
+        self.assertContains(response, "Fleiss&#x27; kappa")
@@ -0,0 +1,45 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from rateslide.anonymous import delete_in_batches, inactive_anonymous_users
+from rateslide.models import CaseInstance
+from rateslide.utils import create_anonymous_user
+
+
+class PurgeAnonymousUsersTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def setUp(self):
+        self.inactive = [create_anonymous_user() for _ in range(3)]
+        self.active = create_anonymous_user()
+        CaseInstance.objects.create(Case_id=1, User=self.active, Status=CaseInstance.ENDED)
+        CaseInstance.objects.create(Case_id=3, User=self.inactive[0], Status=CaseInstance.SKIPPED)
+
+    def test_inactive_anonymous_users(self):
+        self.assertEqual(set(inactive_anonymous_users()), set(self.inactive))
+
+    def test_registered_user_with_anonymous_name_is_kept(self):
+        User.objects.create_user(username='registered', first_name='Anonymous', last_name='User')
+        self.assertEqual(set(inactive_anonymous_users()), set(self.inactive))
+
+    def test_delete_in_batches(self):
+        progress = []
+        self.assertEqual(delete_in_batches(inactive_anonymous_users(), 2, progress.append), 3)
+        self.assertEqual(progress, [2, 3])
+        self.assertTrue(User.objects.filter(pk=self.active.pk).exists())
+        self.assertEqual(User.objects.count(), 4, 'registered users are kept')
+
+    def test_purge_command(self):
+        User.objects.filter(pk=self.inactive[0].pk).update(date_joined=timezone.now() - timedelta(days=40))
+        out = StringIO()
+        call_command('purge_anonymous_users', '--older-than', '30', '--dry-run', stdout=out)
+        self.assertIn('1 anonymous users would be deleted', out.getvalue())
+        self.assertEqual(inactive_anonymous_users().count(), 3)
+        call_command('purge_anonymous_users', '--older-than', '30', stdout=out)
+        self.assertIn('Done, 1 anonymous users deleted', out.getvalue())
+        self.assertEqual(inactive_anonymous_users().count(), 2)
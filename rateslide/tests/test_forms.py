@@ -5,7 +5,7 @@ from django.forms.widgets import TextInput, NumberInput, RadioSelect, DateInput,
 from django.contrib.auth.models import User
 from rateslide.forms import QuestionForm
 
-from rateslide.models import Question, CaseInstance, Answer, AnswerAnnotation
+from rateslide.models import Question, CaseInstance, Answer, AnswerAnnotation, QuestionItem
 
 from .utils import create_case_with_all_question_types
 
@@ -96,3 +96,22 @@ class QuestionFormTests(TestCase):
         self.assertEqual(form.cleaned_data[question_date.fieldid()], date(2018, 2, 13))
         self.assertEqual(form.cleaned_data[question_remark.fieldid()], '')
         self.assertEqual(form.cleaned_data[question_line.fieldid()], '{"length": 1.5, "length_unit": "mm", "slideid": 1, "annotation": ["line", {"x1": "1.0", "y1": "1.0", "x2": "30.0", "y2": "30.0", "stroke": "green", "stroke-width": "3", "vector-effect": "non-scaling-stroke"}]}')
+
+    def test_form_schema_is_cached(self):
+        case = create_case_with_all_question_types()
+        QuestionForm(case, None)
+        with self.assertNumQueries(0):
+            form = QuestionForm(case, None)
+        self.assertEqual(len(form.fields), len(Question.question_type_choices))
+
+    def test_form_schema_follows_changes(self):
+        case = create_case_with_all_question_types()
+        question = Question.objects.get(Case=case, Type=Question.MULTIPLECHOICE)
+        form = QuestionForm(case, None)
+        self.assertEqual(len(form.fields[question.fieldid()].choices), 3)
+        QuestionItem.objects.create(Question=question, Text='Answer 4', Order=4)
+        form = QuestionForm(case, None)
+        self.assertEqual(len(form.fields[question.fieldid()].choices), 4)
+        Question.objects.get(Case=case, Type=Question.DATE).delete()
+        form = QuestionForm(case, None)
+        self.assertEqual(len(form.fields), len(Question.question_type_choices) - 1)
@@ -0,0 +1,101 @@
+from io import StringIO
+from smtplib import SMTPException
+from unittest import mock
+
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from rateslide.mail import queue_mail, send_outbox
+from rateslide.models import CaseList, OutgoingMail, UserCaseList
+from rateslide.utils import MailRenderer, compile_mail_template
+
+
+class OutboxTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def post_reminder(self, usercaselist_ids):
+        data = {'form-TOTAL_FORMS': len(usercaselist_ids), 'form-INITIAL_FORMS': 0, 'submit': 'submitreminder'}
+        for index, usercaselist_id in enumerate(usercaselist_ids):
+            data['form-%d-id' % index] = usercaselist_id
+            data['form-%d-selected' % index] = 'on'
+        self.client.login(username='admin', password='admin')
+        url = reverse('rateslide:submitcaselistusers', kwargs={'caselist_id': 1})
+        return self.client.post(url, data)
+
+    def test_reminder_is_sent_at_once(self):
+        response = self.post_reminder([1, 2])
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].subject, OutgoingMail.REMINDER)
+        self.assertFalse(OutgoingMail.objects.filter(Sent__isnull=True).exists())
+
+    @override_settings(RATESLIDE_MAIL_RATE=1)
+    def test_only_queued_mail_is_sent_at_once(self):
+        retry = OutgoingMail.objects.create(UserCaseList_id=2, MailType=OutgoingMail.WELCOME, Attempts=1)
+        with mock.patch('rateslide.mail.sleep') as sleep:
+            self.post_reminder([1])
+        self.assertEqual([message.subject for message in mail.outbox], [OutgoingMail.REMINDER])
+        self.assertFalse(sleep.called, 'the request does not wait for the rate limit')
+        retry.refresh_from_db()
+        self.assertIsNone(retry.Sent, 'retries are left to the outbox command')
+
+    @override_settings(RATESLIDE_MAIL_OUTBOX=True)
+    def test_reminder_waits_in_outbox(self):
+        UserCaseList.objects.filter(pk=2).update(Status=UserCaseList.PENDING)
+        self.post_reminder([1, 2])
+        self.assertEqual(len(mail.outbox), 0, 'the request does not send mail')
+        self.assertEqual(OutgoingMail.objects.count(), 1, 'only active users are reminded')
+        out = StringIO()
+        call_command('send_mail_outbox', stdout=out)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('Sent 1 mails', out.getvalue())
+        self.assertEqual(send_outbox(), (0, 0), 'sent mail is not sent again')
+
+    @override_settings(RATESLIDE_MAIL_OUTBOX=True)
+    def test_failed_mail_is_retried_later(self):
+        self.post_reminder([1])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=SMTPException('unavailable')):
+            self.assertEqual(send_outbox(), (0, 1))
+        outgoing = OutgoingMail.objects.get()
+        self.assertEqual((outgoing.Attempts, outgoing.Error), (1, 'unavailable'))
+        self.assertEqual(send_outbox(), (0, 0), 'not due yet')
+        OutgoingMail.objects.update(NextAttempt=outgoing.Created)
+        self.assertEqual(send_outbox(), (1, 0))
+
+    @override_settings(RATESLIDE_MAIL_OUTBOX=True)
+    def test_outbox_queries_do_not_grow_with_mail(self):
+        queue_mail([1], OutgoingMail.REMINDER)
+        Site.objects.clear_cache()
+        with CaptureQueriesContext(connection) as single:
+            send_outbox()
+        queue_mail([1, 2, 1, 2], OutgoingMail.REMINDER)
+        Site.objects.clear_cache()
+        with CaptureQueriesContext(connection) as several:
+            send_outbox()
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(len(several), len(single))
+
+
+class MailRendererTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def test_compile_mail_template(self):
+        segments = compile_mail_template('Dear %first_name%, see %caselisturl% before %deadline%. 100%')
+        self.assertEqual(segments[1::2], ['first_name', 'caselisturl', 'deadline'])
+        self.assertEqual(segments[-1], '. 100%')
+
+    def test_render(self):
+        CaseList.objects.filter(pk=1).update(ReminderMail='Hi %username%, %caselisturl%')
+        usercaselists = list(UserCaseList.objects.filter(CaseList=1).select_related('User', 'CaseList').order_by('pk'))
+        renderer = MailRenderer()
+        url = str(Site.objects.get_current()) + reverse('rateslide:caselist', args=['simple-case'])
+        self.assertEqual(renderer.render(usercaselists[0], OutgoingMail.REMINDER), 'Hi user, ' + url)
+        with self.assertNumQueries(0):
+            self.assertEqual(renderer.render(usercaselists[1], OutgoingMail.REMINDER), 'Hi caselistowner, ' + url)
+        self.assertEqual(renderer.render(usercaselists[0], 'unknown'), 'Invalid mail_type')
@@ -1,6 +1,15 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
 
-from rateslide.models import Question
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from rateslide import assignment
+from rateslide.models import Case, Question, CaseList, CaseInstance, Answer, QuestionStatistics, TextSketch, \
+                             UserCaseList, CaseListScore
 
 
 class QuestionTests(TestCase):
@@ -18,3 +27,248 @@ class QuestionTests(TestCase):
 
         question = Question.objects.create(Case_id=1, Type=Question.NUMERIC, Required=False, Order=3, Text='Question 3')
         self.assertEqual(question.fieldid(), 'question_F_N_' + str(question.id))
+
+
+class CaseListTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def test_progress(self):
+        cl = CaseList.objects.get(pk=1)
+        progress = cl.progress(1)
+        self.assertEqual(progress.completed, {1, 6})
+        self.assertEqual(progress.count_completed, 2)
+        self.assertEqual(progress.count_skipped, 0)
+        self.assertEqual(progress.count_todo, 3)
+        self.assertEqual(progress.count_total, 5)
+
+    def test_progress_skipped(self):
+        cl = CaseList.objects.get(pk=1)
+        CaseInstance.objects.create(Case_id=3, User_id=1, Status=CaseInstance.SKIPPED)
+        progress = cl.progress(1)
+        self.assertEqual(progress.count_completed, 2)
+        self.assertEqual(progress.count_skipped, 1)
+        self.assertEqual(progress.count_todo, 2)
+        self.assertEqual(progress.count_total, 4)
+
+    def test_progress_single_query(self):
+        cl = CaseList.objects.get(pk=1)
+        with self.assertNumQueries(1):
+            cl.progress(2)
+
+    def test_user_progress(self):
+        cl = CaseList.objects.get(pk=1)
+        CaseInstance.objects.create(Case_id=3, User_id=2, Status=CaseInstance.SKIPPED)
+        progress = cl.user_progress([1, 2, 3])
+        self.assertEqual(progress[1].count_completed, 2)
+        self.assertEqual(progress[1].count_total, 5)
+        self.assertEqual(progress[2].count_completed, 0)
+        self.assertEqual(progress[2].count_total, 4)
+        self.assertEqual(progress[3].count_todo, 5)
+
+    def test_get_next_case(self):
+        cl = CaseList.objects.get(pk=1)
+        self.assertEqual(cl.get_next_case(1), 3, 'lowest Order that has not been seen')
+        CaseInstance.objects.create(Case_id=3, User_id=1, Status=CaseInstance.SKIPPED)
+        self.assertIn(cl.get_next_case(1), (4, 5), 'random choice between cases with the same Order')
+
+    def test_get_next_case_observers_per_case(self):
+        cl = CaseList.objects.get(pk=1)
+        cl.ObserversPerCase = 1
+        cl.save()
+        for case_id in (3, 4):
+            CaseInstance.objects.create(Case_id=case_id, User_id=3, Status=CaseInstance.ENDED)
+        self.assertEqual(cl.get_next_case(1), 5, 'least observed case')
+        self.assertEqual(CaseInstance.objects.get(Case_id=5, User_id=1).Status, CaseInstance.OPEN, 'case is reserved')
+        self.assertEqual(cl.get_next_case(1), 5, 'reservation is kept')
+        self.assertEqual(cl.get_next_case(2), -1, 'all cases reached the limit')
+
+    @override_settings(RATESLIDE_RESERVATION_TIMEOUT=0)
+    def test_get_next_case_expired_reservation(self):
+        cl = CaseList.objects.get(pk=1)
+        cl.ObserversPerCase = 1
+        cl.save()
+        for case_id in (3, 4):
+            CaseInstance.objects.create(Case_id=case_id, User_id=3, Status=CaseInstance.ENDED)
+        self.assertEqual(cl.get_next_case(1), 5)
+        self.assertEqual(cl.get_next_case(2), 5, 'expired reservation is given to the next user')
+        self.assertFalse(CaseInstance.objects.filter(Case_id=5, User_id=1).exists())
+
+    def test_get_next_case_reservation_time(self):
+        cl = CaseList.objects.get(pk=1)
+        cl.ObserversPerCase = 1
+        cl.save()
+        for case_id in (3, 4):
+            CaseInstance.objects.create(Case_id=case_id, User_id=3, Status=CaseInstance.ENDED)
+        self.assertEqual(cl.get_next_case(1), 5)
+        reservation = CaseInstance.objects.get(Case_id=5, User_id=1)
+        reservation.Reserved = timezone.now() - timedelta(seconds=assignment.reservation_timeout() + 1)
+        reservation.save()
+        self.assertEqual(cl.get_next_case(2), 5, 'saving the caseinstance does not extend the reservation')
+        self.assertEqual(cl.get_next_case(1), -1, 'the case is reserved for the next user')
+
+    def test_submission_after_reservation_expired(self):
+        cl = CaseList.objects.get(pk=1)
+        cl.ObserversPerCase = 1
+        cl.save()
+        case = Case.objects.get(pk=5)
+        expired = timezone.now() - timedelta(seconds=assignment.reservation_timeout() + 1)
+        reservation = CaseInstance.objects.create(Case=case, User_id=1, Status=CaseInstance.OPEN, Reserved=expired)
+        self.assertEqual(assignment.submission_caseinstance(case, 1), reservation, 'the case was not given away')
+        reservation.delete()
+        CaseInstance.objects.create(Case=case, User_id=2, Status=CaseInstance.OPEN, Reserved=timezone.now())
+        self.assertIsNone(assignment.submission_caseinstance(case, 1), 'the case was reserved by another user')
+        self.assertEqual(assignment.submission_caseinstance(case, 2).Status, CaseInstance.OPEN)
+
+    @override_settings(RATESLIDE_CASE_QUEUE=True)
+    def test_get_next_case_queue(self):
+        cl = CaseList.objects.get(pk=1)
+        self.assertEqual(cl.get_next_case(2), 1)
+        self.assertEqual(cl.get_next_case(2), 1, 'case is not popped until it is seen')
+        CaseInstance.objects.create(Case_id=1, User_id=2, Status=CaseInstance.ENDED)
+        self.assertEqual(cl.get_next_case(2), 3)
+        for case_id in (3, 4, 5, 6):
+            CaseInstance.objects.create(Case_id=case_id, User_id=2, Status=CaseInstance.ENDED)
+        self.assertEqual(cl.get_next_case(2), -1)
+
+    def test_grade_counts(self):
+        cl = CaseList.objects.get(pk=1)
+        self.assertEqual(cl.grade_counts(1), {'graded': 1, 'correct': 1})
+        self.assertEqual(cl.evaluation(1), '1 of 1')
+        Answer.objects.filter(pk=1).update(AnswerNumeric=3)
+        self.assertEqual(cl.evaluation(1), '0 of 1')
+        self.assertEqual(cl.user_grade_counts(), {1: {'graded': 1, 'correct': 0}})
+        self.assertEqual(cl.evaluation(2), '')
+
+    def test_graded_matches_grade(self):
+        Answer.objects.create(CaseInstance_id=1, Question_id=3, AnswerText='2')
+        Question.objects.filter(pk=3).update(CorrectAnswer='2')
+        for answer in Answer.objects.graded():
+            self.assertEqual(answer.grade_code, Answer.objects.get(pk=answer.pk).grade())
+
+    def test_rebuild_scores(self):
+        cl = CaseList.objects.get(pk=1)
+        cl.Type = CaseList.EXAMINATION
+        cl.save()
+        self.assertEqual(cl.score(1), '1 of 1', 'missing score is counted')
+        self.assertFalse(CaseListScore.objects.exists(), 'reading a score does not store it')
+        CaseListScore.get_score(cl, 1)
+        Question.objects.filter(pk=1).update(CorrectAnswer='3')
+        self.assertEqual(cl.score(1), '1 of 1', 'stored score is not regraded')
+        call_command('rebuild_scores', 'simple-case', stdout=StringIO())
+        self.assertEqual(cl.score(1), '0 of 1')
+        self.assertEqual(list(cl.scores().values_list('User', flat=True)), [1])
+
+
+class QuestionStatisticsTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def test_running_statistics(self):
+        statistics = QuestionStatistics(Question_id=5)
+        statistics.apply(Question.NUMERIC, [], [4, 7, 13, 16])
+        self.assertEqual((statistics.Count, statistics.Mean), (4, 10))
+        self.assertAlmostEqual(statistics.sd() ** 2, 30)
+        statistics.apply(Question.NUMERIC, [16], [10])
+        self.assertEqual((statistics.Count, statistics.Mean, statistics.Max), (4, 8.5, 13))
+        self.assertAlmostEqual(statistics.sd() ** 2, 15)
+        self.assertEqual(statistics.value_counts(), {4: 1, 7: 1, 10: 1, 13: 1})
+        statistics.apply(Question.NUMERIC, [4, 7, 10, 13], [])
+        self.assertEqual((statistics.Count, statistics.Mean, statistics.Min, statistics.Counts), (0, 0, None, '{}'))
+
+    def test_missing_statistics_are_computed(self):
+        statistics = QuestionStatistics.get_statistics({1: Question.MULTIPLECHOICE})[1]
+        self.assertEqual((statistics.Count, statistics.value_counts()), (1, {2: 1}))
+        QuestionStatistics.update({1: (Question.MULTIPLECHOICE, [2], [1])})
+        statistics.refresh_from_db()
+        self.assertEqual(statistics.value_counts(), {1: 1})
+
+    def test_rebuild_question_statistics(self):
+        QuestionStatistics.get_statistics({1: Question.MULTIPLECHOICE})
+        Answer.objects.filter(Question=1).update(AnswerNumeric=3)
+        call_command('rebuild_question_statistics', 'simple-case', stdout=StringIO())
+        self.assertEqual(QuestionStatistics.objects.get(Question=1).value_counts(), {3: 1})
+
+
+class TextSketchTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def test_space_saving(self):
+        sketch = TextSketch(Question_id=6)
+        sketch.apply([], ['a', 'a', 'b', 'c'], 2)
+        self.assertEqual(sketch.top(), [('a', 2, 0), ('c', 2, 1)], 'c replaced b and may be overcounted')
+        sketch.apply(['a'], [], 2)
+        self.assertEqual((sketch.Total, sketch.top()), (3, [('c', 2, 1), ('a', 1, 0)]),
+                         'the count of c is an upper bound, it is kept when a is removed')
+
+    def test_space_saving_after_removal(self):
+        sketch = TextSketch(Question_id=6)
+        sketch.apply([], ['a', 'b', 'c'], 2)
+        sketch.apply(['b'], ['a'], 2)
+        self.assertEqual(sketch.top(), [('a', 2, 1), ('c', 2, 1)], 'a may have been replaced by c before')
+
+    @override_settings(RATESLIDE_TEXT_SKETCH_SIZE=10)
+    def test_update_sketch(self):
+        sketch = TextSketch.get_sketches([6])[6]
+        self.assertEqual(sketch.top(), [('3', 1, 0)], 'missing sketch counted from the answers')
+        TextSketch.update({6: (Question.OPENTEXT, [], ['4'])})
+        sketch.refresh_from_db()
+        self.assertEqual(sketch.top(), [('3', 1, 0), ('4', 1, 0)])
+        TextSketch.update({6: (Question.OPENTEXT, ['3'], ['4'])})
+        sketch.refresh_from_db()
+        self.assertEqual((sketch.Total, sketch.top()), (2, [('4', 2, 0)]))
+
+    @override_settings(RATESLIDE_TEXT_SKETCH_SIZE=1)
+    def test_rebuilt_sketch_floor(self):
+        Answer.objects.create(CaseInstance_id=1, Question_id=6, AnswerText='4')
+        sketch = TextSketch.get_sketches([6])[6]
+        self.assertEqual((sketch.top(), sketch.Floor), ([('3', 1, 0)], 1), 'the text left out was given once')
+
+    def test_disabled_sketch_is_not_stored(self):
+        TextSketch.update({6: (Question.OPENTEXT, [], ['4'])})
+        self.assertFalse(TextSketch.objects.exists())
+
+
+class IndexTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def test_usercaselist_is_unique(self):
+        with self.assertRaises(IntegrityError):
+            UserCaseList.objects.create(User_id=2, CaseList_id=1)
+
+    def test_benchmark_queries(self):
+        out = StringIO()
+        call_command('benchmark_queries', '--repeat', '2', stdout=out)
+        self.assertIn('answers of question: median', out.getvalue())
+
+
+@override_settings(RATESLIDE_METADATA_CACHE_TIMEOUT=60)
+class MetadataCacheTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_caselist_by_slug_is_cached(self):
+        CaseList.get_cached_by_slug('simple-case')
+        with self.assertNumQueries(0):
+            cl = CaseList.get_cached_by_slug('simple-case')
+        cl.Name = 'Renamed'
+        cl.save()
+        self.assertEqual(CaseList.get_cached_by_slug('simple-case').Name, 'Renamed', 'invalidated on save')
+        cl.delete()
+        with self.assertRaises(CaseList.DoesNotExist):
+            CaseList.get_cached_by_slug('simple-case')
+
+    def test_case_is_cached_with_caselist(self):
+        Case.get_cached(1)
+        with self.assertNumQueries(0):
+            self.assertTrue(Case.get_cached(1).Caselist.is_active())
+        cl = CaseList.objects.get(pk=1)
+        cl.EndDate = timezone.now() - timedelta(days=1)
+        cl.save()
+        self.assertFalse(Case.get_cached(1).Caselist.is_active(), 'caselist of a cached case is invalidated')
+        Case.objects.filter(pk=1).delete()
+        with self.assertRaises(Case.DoesNotExist):
+            Case.get_cached(1)
@@ -0,0 +1,101 @@
+from os import path, listdir, utime
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+from unittest import mock
+
+import numpy as np
+from django.test import TestCase, override_settings
+
+from rateslide import reports
+from rateslide.models import Question
+
+from .utils import populate_answers
+
+
+class HistogramTests(TestCase):
+    def setUp(self):
+        self.media_root = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.media_root)
+
+    def test_histogram_is_rendered_once(self):
+        with override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL='/media/'):
+            with mock.patch('rateslide.reports.render_histogram', wraps=reports.render_histogram) as render:
+                url = reports.generate_report_histogram([1, 2, 2, 3], 1)
+                self.assertEqual(reports.generate_report_histogram([1, 2, 2, 3], 1), url)
+                self.assertEqual(render.call_count, 1, 'unchanged data is not rendered again')
+        self.assertTrue(path.exists(path.join(self.media_root, url[len('/media/'):])))
+
+    def test_changed_data_replaces_histogram(self):
+        directory = path.join(self.media_root, reports.HISTOGRAM_DIR)
+        with override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL='/media/'):
+            first = reports.generate_report_histogram([1, 2, 2, 3], 1)
+            second = reports.generate_report_histogram([1, 2, 2, 3, 4], 1)
+            self.assertNotEqual(first, second)
+            self.assertEqual(len(listdir(directory)), 2, 'a recent histogram may still be shown by a report')
+            old = time() - reports.HISTOGRAM_MAX_AGE - 1
+            utime(path.join(directory, path.basename(second)), (old, old))
+            reports.generate_report_histogram([1, 2, 2, 3, 4, 5], 1)
+        self.assertEqual(len(listdir(directory)), 2, 'the unused histogram is removed')
+        self.assertNotIn(path.basename(second), listdir(directory))
+
+    def test_failed_render_leaves_no_file(self):
+        with override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL='/media/'):
+            with mock.patch('matplotlib.figure.Figure.savefig', side_effect=ValueError):
+                with self.assertRaises(ValueError):
+                    reports.generate_report_histogram([1, 2, 2, 3], 1)
+        self.assertEqual(listdir(path.join(self.media_root, reports.HISTOGRAM_DIR)), [])
+
+    def test_busy_histogram_is_awaited(self):
+        x = np.asarray([1, 2, 2, 3])
+        filename = path.join(self.media_root, reports.histogram_name(x, 1))
+        render_elsewhere = reports.render_histogram
+        with override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL='/media/'):
+            with mock.patch('rateslide.reports.cache.add', return_value=False), \
+                    mock.patch('rateslide.reports.sleep', side_effect=lambda seconds: render_elsewhere(x, filename)), \
+                    mock.patch('rateslide.reports.render_histogram') as render:
+                reports.generate_report_histogram(x, 1)
+        self.assertFalse(render.called, 'the report that holds the lock renders the image')
+
+    def test_abandoned_histogram_is_rendered(self):
+        with override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL='/media/'):
+            with mock.patch('rateslide.reports.cache.add', return_value=False), \
+                    mock.patch('rateslide.reports.HISTOGRAM_LOCK_TIMEOUT', 0):
+                url = reports.generate_report_histogram([1, 2, 2, 3], 1)
+        self.assertTrue(path.exists(path.join(self.media_root, url[len('/media/'):])))
+
+
+class HistogramDataTests(TestCase):
+    def test_histogram_data(self):
+        histogram = reports.histogram_data([1, 2, 2, 3])
+        self.assertEqual(sum(histogram['counts']), 4)
+        self.assertEqual(len(histogram['edges']), len(histogram['counts']) + 1)
+        self.assertEqual(histogram['colors'][0], '#440154', 'viridis starts dark purple')
+        self.assertEqual(histogram['colors'][-1], '#fde725', 'viridis ends yellow')
+
+
+class CaseReportTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def test_case_report_questions(self):
+        case = populate_answers(3)
+        reports.case_report_questions(case, 'svg')
+        with self.assertNumQueries(6):
+            questions = {question['Type']: question for question in reports.case_report_questions(case, 'svg')}
+        self.assertEqual(questions[Question.NUMERIC]['data'], [(0, 2, 1.0, 1.0)])
+        self.assertEqual(questions[Question.MULTIPLECHOICE]['data'],
+                         [(1, '33%', 'Choice 1'), (1, '33%', 'Choice 2'), (1, '33%', 'Choice 3')])
+        self.assertEqual(questions[Question.OPENTEXT]['total_answers'], 3)
+        self.assertEqual(len(questions[Question.OPENTEXT]['data']), 3)
+        self.assertEqual(questions[Question.LINE]['data'], [('1 mm', '3 mm', '2 mm', '1 mm')])
+
+    @override_settings(RATESLIDE_TEXT_SKETCH_SIZE=2)
+    def test_case_report_text_sketch(self):
+        case = populate_answers(3)
+        reports.case_report_questions(case, 'svg')
+        with self.assertNumQueries(6):
+            questions = {question['Type']: question for question in reports.case_report_questions(case, 'svg')}
+        self.assertEqual(questions[Question.OPENTEXT]['total_answers'], 3)
+        self.assertEqual(questions[Question.OPENTEXT]['data'], [(1, '33%', 'Answer0', 0), (1, '33%', 'Answer1', 0)])
@@ -1,18 +1,23 @@
 from json import dumps, loads
+import os
+import subprocess
+import sys
 from testfixtures import Replace, test_datetime
 from datetime import datetime
 
 from django.http import HttpRequest
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.urls import reverse
 from django.contrib.auth.models import User
 
 from histoslide.models import Slide
 from rateslide.models import CaseBookmark, Case, CaseInstance, QuestionBookmark, Question, CaseList, Answer, \
-                             UserCaseList
+                             UserCaseList, CaseListScore, QuestionStatistics
 from rateslide.views import deleteemptyanonymoususercaselists, get_caselist_data
 from rateslide.utils import create_anonymous_user
-from .utils import populate_answers
+from .utils import populate_answers, create_case_with_all_question_types
 
 
 class CaseTests(TestCase):
@@ -38,6 +43,66 @@ class CaseTests(TestCase):
         self.assertTemplateUsed(response, 'rateslide/case.html')
         self.assertEqual(User.objects.count(), usercount, 'Usercount should stay the same')
 
+    def test_case_loads_usercaselist_once(self):
+        url = reverse('rateslide:case', kwargs={'case_id': 1})
+        self.client.login(username='user', password='user')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([query for query in queries if 'rateslide_usercaselist' in query['sql']]), 1)
+
+    def test_case_anonymous_visits_do_not_write(self):
+        usercount = User.objects.count()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(reverse('rateslide:caselist', kwargs={'slug': 'simple-case'})).status_code,
+                             200)
+            self.assertEqual(self.client.get(reverse('rateslide:case', kwargs={'case_id': 1})).status_code, 200)
+        writes = [query for query in queries if query['sql'].split()[0] in ('INSERT', 'UPDATE', 'DELETE')]
+        self.assertEqual(writes, [])
+        self.assertEqual(User.objects.count(), usercount)
+        self.assertNotIn('slideobs_user', self.client.cookies)
+
+    def test_next_case_anonymous_limited_does_not_reserve(self):
+        cl = CaseList.objects.get(pk=1)
+        cl.ObserversPerCase = 2
+        cl.save()
+        usercount = User.objects.count()
+        response = self.client.get(reverse('rateslide:next-case', kwargs={'slug': 'simple-case'}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(User.objects.count(), usercount)
+        self.assertFalse(CaseInstance.objects.filter(Status=CaseInstance.OPEN).exists())
+        self.assertNotIn('slideobs_user', self.client.cookies)
+
+    def test_case_anonymous_submit_creates_participant(self):
+        url = reverse('rateslide:submitcase', kwargs={'case_id': 1})
+        response = self.client.post(url, {'question_R_M_1': '1', 'submit': 'submit'})
+        self.assertEqual(response.status_code, 302)
+        user = User.objects.get(anonymousparticipant__isnull=False)
+        self.assertEqual(UserCaseList.objects.filter(User=user).count(), 1)
+        self.assertNotEqual(self.client.cookies['slideobs_user'].value, user.username, 'The cookie is signed')
+        # The next submission is recognised by the cookie
+        response = self.client.post(url, {'question_R_M_1': '2', 'submit': 'submit'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(User.objects.filter(anonymousparticipant__isnull=False).count(), 1)
+        self.assertEqual(CaseInstance.objects.filter(User=user).count(), 1)
+
+    def test_case_anonymous_invalid_submit_does_not_create_participant(self):
+        url = reverse('rateslide:submitcase', kwargs={'case_id': 1})
+        response = self.client.post(url, {'submit': 'submit'})
+        self.assertEqual(response.status_code, 200, 'the form is shown again')
+        self.assertFalse(User.objects.filter(anonymousparticipant__isnull=False).exists())
+
+    def test_case_unsigned_participant_cookie(self):
+        user = create_anonymous_user()
+        url = reverse('rateslide:submitcase', kwargs={'case_id': 1})
+        self.client.cookies['slideobs_user'] = user.username
+        self.client.post(url, {'question_R_M_1': '1', 'submit': 'submit'})
+        self.assertFalse(CaseInstance.objects.filter(User=user).exists(), 'a plain username is not trusted')
+        self.client.cookies['slideobs_user'] = user.username
+        with self.settings(RATESLIDE_ACCEPT_UNSIGNED_PARTICIPANT_COOKIE=True):
+            self.client.post(url, {'question_R_M_1': '1', 'submit': 'submit'})
+        self.assertTrue(CaseInstance.objects.filter(User=user).exists())
+
     def test_case_post(self):
         cl = CaseList.objects.get(pk=1)
         cl.VisibleForNonUsers = False
@@ -82,6 +147,83 @@ class CaseTests(TestCase):
         ans = Answer.objects.filter(CaseInstance=ci[0].pk)
         self.assertEqual(ans.count(), 0, 'should be 0 answer in case, Optional answer not given')
 
+    def test_case_post_ends_reservation(self):
+        cl = CaseList.objects.get(pk=1)
+        cl.VisibleForNonUsers = False
+        cl.save()
+        user = User.objects.get(username='user')
+        CaseInstance.objects.create(Case_id=1, User=user, Status=CaseInstance.OPEN)
+        url = reverse('rateslide:submitcase', kwargs={'case_id': 1})
+        self.client.login(username='user', password='user')
+        self.client.post(url, {'question_R_M_1': '1', 'question_F_R_2': 'Test', 'submit': 'submit', })
+        ci = CaseInstance.objects.get(Case__id=1, User=user)
+        self.assertEqual(ci.Status, CaseInstance.ENDED)
+
+    def test_case_post_after_reservation_was_given_away(self):
+        cl = CaseList.objects.get(pk=1)
+        cl.VisibleForNonUsers = False
+        cl.ObserversPerCase = 1
+        cl.save()
+        url = reverse('rateslide:submitcase', kwargs={'case_id': 1})
+        self.client.login(username='user', password='user')
+        response = self.client.post(url, {'question_R_M_1': '1', 'question_F_R_2': 'Test', 'submit': 'submit', })
+        self.assertContains(response, 'Your reservation of this case has expired')
+        self.assertFalse(CaseInstance.objects.filter(Case_id=1, User__username='user').exists(),
+                         'admin is the only observer of case 1')
+
+    def test_case_post_updates_score(self):
+        cl = CaseList.objects.get(pk=1)
+        cl.VisibleForNonUsers = False
+        cl.Type = CaseList.EXAMINATION
+        cl.save()
+        user = User.objects.get(username='user')
+        url = reverse('rateslide:submitcase', kwargs={'case_id': 1})
+        self.client.login(username='user', password='user')
+        self.client.post(url, {'question_R_M_1': '2', 'question_F_R_2': 'Test', 'submit': 'submit', })
+        self.assertEqual(cl.score(user.pk), '1 of 1')
+        self.client.post(url, {'question_R_M_1': '3', 'question_F_R_2': 'Test', 'submit': 'submit', })
+        self.assertEqual(cl.score(user.pk), '0 of 1')
+        self.assertEqual(CaseListScore.objects.filter(CaseList=cl).count(), 1)
+
+    def test_caselist_shows_evaluation_without_storing_score(self):
+        self.client.login(username='user', password='user')
+        self.client.post(reverse('rateslide:submitcase', kwargs={'case_id': 1}),
+                         {'question_R_M_1': '2', 'submit': 'submit'})
+        response = self.client.get(reverse('rateslide:caselist', kwargs={'slug': 'simple-case'}))
+        self.assertEqual(response.context['UserDict']['case_evaluation'], '1 of 1',
+                         'correct answers are evaluated in every type of caselist')
+        self.assertFalse(CaseListScore.objects.exists())
+
+    def test_case_post_all_question_types(self):
+        cl = CaseList.objects.get(pk=1)
+        cl.VisibleForNonUsers = False
+        cl.save()
+        case = create_case_with_all_question_types()
+        questions = {question.Type: question.fieldid() for question in Question.objects.filter(Case=case)}
+        line = '{"length": 2, "length_unit": "mm", "slideid": 1, "annotation": ["line", {"x1": "1.0"}]}'
+        data = {questions[Question.OPENTEXT]: 'plain text', questions[Question.NUMERIC]: '5',
+                questions[Question.MULTIPLECHOICE]: '1', questions[Question.DATE]: '2018-1-10',
+                questions[Question.REMARK]: 'remark', questions[Question.LINE]: line, 'submit': 'submit'}
+        url = reverse('rateslide:submitcase', kwargs={'case_id': case.id})
+        self.client.login(username='user', password='user')
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 302)
+        answers = Answer.objects.filter(CaseInstance__Case=case)
+        self.assertEqual(answers.count(), 5, 'remark is skipped')
+        self.assertEqual(answers.get(Question__Type=Question.DATE).AnswerText, '2018-01-10')
+        self.assertEqual(answers.get(Question__Type=Question.LINE).answerannotation.Length, 2)
+        line = '{"length": 3, "length_unit": "mm", "slideid": 1, "annotation": ["line", {"x1": "2.0"}]}'
+        data.update({questions[Question.OPENTEXT]: '', questions[Question.NUMERIC]: '6',
+                     questions[Question.LINE]: line})
+        self.client.post(url, data)
+        self.assertEqual(answers.count(), 4, 'cleared answer is deleted')
+        self.assertEqual(answers.get(Question__Type=Question.NUMERIC).AnswerNumeric, 6)
+        self.assertEqual(answers.get(Question__Type=Question.LINE).answerannotation.Length, 3)
+        statistics = QuestionStatistics.objects.get(Question__Case=case, Question__Type=Question.NUMERIC)
+        self.assertEqual((statistics.Count, statistics.Mean, statistics.value_counts()), (1, 6, {6: 1}))
+        statistics = QuestionStatistics.objects.get(Question__Case=case, Question__Type=Question.LINE)
+        self.assertEqual((statistics.Count, statistics.Min, statistics.Max), (1, 3, 3))
+
     def test_case_update(self):
         cl = CaseList.objects.get(pk=1)
         cl.VisibleForNonUsers = False
@@ -105,6 +247,9 @@ class CaseTests(TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'rateslide/case.html')
+        self.assertEqual(User.objects.count(), usercount, 'A anonymous user is created on the first submission')
+        url = reverse('rateslide:submitcase', kwargs={'case_id': 1})
+        self.client.post(url, {'question_R_M_1': '1', 'submit': 'submit'})
         self.assertEqual(User.objects.count(), usercount+1, 'A anonymous user should be created')
         url = reverse('rateslide:case', kwargs={'case_id': 3})
         response = self.client.get(url)
@@ -171,6 +316,20 @@ class CaseTests(TestCase):
         self.assertTemplateUsed(response, 'rateslide/casereport.html')
         self.assertContains(response, 'questionreport', count=2)
 
+    def test_caselistexport(self):
+        populate_answers(2)
+        url = reverse('rateslide:caselistexport', kwargs={'slug': 'simple-case'})
+        self.client.login(username='user', password='user')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404, 'Export is exclusive for admins')
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(url, {'format': 'tsv'})
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 1 + 2 + 8, 'header, fixture answers and populated answers')
+        self.assertTrue(lines[0].startswith('user_id\tusername\t'))
+        self.assertIn('Choice 2', '\n'.join(lines), 'multiple choice text is exported')
+
     def test_usercaselist_loads(self):
         url = reverse('rateslide:usercaselist', kwargs={'usercaselist_id': 1})
         response = self.client.get(url)
@@ -191,6 +350,14 @@ class CaseTests(TestCase):
         response = self.client.get(url)
         self.assertContains(response, 'questionreport', count=4)
 
+    def test_casereport_svg_histograms(self):
+        case = populate_answers(3)
+        url = reverse('rateslide:casereport', kwargs={'case_id': case.id})
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(url, {'histograms': 'svg'})
+        self.assertContains(response, 'data-histogram', count=2)
+        self.assertNotContains(response, '<img')
+
     def test_line_answer_without_annotation(self):
         cl = CaseList.objects.get(pk=1)
         case = Case.objects.create(Name='Exam case generated 2', Caselist=cl, Introduction='Test')
@@ -246,6 +413,51 @@ class CaseTests(TestCase):
             self.assertNotContains(response, 'Rate next case', msg_prefix='Current date is after active period')
 
 
+class StartupTests(TestCase):
+    fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
+
+    def test_participant_views_do_not_import_plotting(self):
+        # Block numpy and matplotlib and unload the modules that use them, as in a worker that never showed a report.
+        # Importing a blocked module raises ImportError.
+        unloaded = {name: module for name, module in sys.modules.items()
+                    if name.split('.')[0] in ('numpy', 'matplotlib') or
+                    name in ('rateslide.reports', 'rateslide.analysis')}
+        for name in unloaded:
+            del sys.modules[name]
+        sys.modules.update({'numpy': None, 'matplotlib': None})
+        try:
+            self.client.login(username='user', password='user')
+            self.assertEqual(self.client.get(reverse('rateslide:caselist', kwargs={'slug': 'simple-case'})).status_code,
+                             200)
+            self.assertEqual(self.client.get(reverse('rateslide:case', kwargs={'case_id': 1})).status_code, 200)
+            response = self.client.post(reverse('rateslide:submitcase', kwargs={'case_id': 1}),
+                                        {'question_R_M_1': '1', 'submit': 'submit'})
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(self.client.get(reverse('rateslide:next-case', kwargs={'slug': 'simple-case'})).
+                             status_code, 302)
+        finally:
+            del sys.modules['numpy'], sys.modules['matplotlib']
+            sys.modules.update(unloaded)
+
+    def test_participant_path_does_not_import_plotting(self):
+        # Load the URLconf and the participant views in a fresh interpreter, as a new worker process would
+        code = '\n'.join(['import sys, time',
+                          'import django',
+                          'start = time.perf_counter()',
+                          'django.setup()',
+                          'import rateslide.urls',
+                          'from django.urls import reverse',
+                          'reverse("rateslide:case", kwargs={"case_id": 1})',
+                          'print("%.3f" % (time.perf_counter() - start))',
+                          'print("matplotlib" in sys.modules or "numpy" in sys.modules)'])
+        result = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True, env=os.environ.copy())
+        self.assertEqual(result.returncode, 0, result.stderr)
+        startup_time, plotting_loaded = result.stdout.split()
+        self.assertEqual(plotting_loaded, 'False',
+                         'numpy or matplotlib is imported on the participant path, startup took %s s' % startup_time)
+
+
 class BookmarkTests(TestCase):
     fixtures = ['rateslide_auth.json', 'rateslide_simplecase.json']
 
@@ -464,3 +676,18 @@ class CaseListAdminTests(TestCase):
         request.user = User.objects.get(username='caselistowner')
         ucldata = get_caselist_data(request, caselist)
         self.assertEqual(ucldata['Users'].count(), 2, 'Only contains MyActive and caselistowner')
+
+    def test_caselistadmin_queries_do_not_grow_with_users(self):
+        url = reverse('rateslide:caselistadmin', kwargs={'slug': 'simple-case'})
+        self.client.login(username='admin', password='admin')
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(url)
+        cl = CaseList.objects.get(pk=1)
+        for index in range(5):
+            user = User.objects.create_user(username='participant%d' % index)
+            UserCaseList.objects.create(User=user, CaseList=cl, Status=UserCaseList.ACTIVE)
+            CaseInstance.objects.create(Case_id=1, User=user, Status=CaseInstance.ENDED)
+        with CaptureQueriesContext(connection) as after:
+            response = self.client.get(url)
+        self.assertContains(response, '1 / 5')
+        self.assertEqual(len(before), len(after), 'Query count should not depend on the number of users')
@@ -10,6 +10,8 @@ urlpatterns = [
     url(r'^showcaselist/(?P<slug>.+)/$', views.showcaselist, name='showcaselist'),
     url(r'^caselistreport/(?P<slug>.+)/$', views.caselistreport, name='caselistreport'),
     url(r'^caselistadmin/(?P<slug>.+)/$', views.caselistadmin, name='caselistadmin'),
+    url(r'^caselistexport/(?P<slug>.+)/$', views.caselistexport, name='caselistexport'),
+    url(r'^caselistmatrix/(?P<slug>.+)/$', views.caselistmatrix, name='caselistmatrix'),
     url(r'^submitcaselist/(?P<caselist_id>\d+)/$', views.submitcaselist, name='submitcaselist'),
     url(r'^submitcaselistusers/(?P<caselist_id>\d+)/$', views.submitcaselistusers, name='submitcaselistusers'),
     url(r'^usercaselist/(?P<usercaselist_id>\d+)/$', views.usercaselist, name='usercaselist'),
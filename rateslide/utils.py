@@ -1,17 +1,67 @@
+import re
 import string
 import random
 
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-from django.core.mail import send_mail
 from django.urls import reverse
 from django.template import Template
 from django.template.defaulttags import register
 
+from .models import AnonymousParticipant
+
+
+# Variables that can be used in the mails of a caselist
+MAIL_VARIABLES = re.compile(r'%(first_name|last_name|username|deadline|caselisturl)%')
+MAIL_FIELDS = {'invite': 'InviteMail', 'welcome': 'WelcomeMail', 'reminder': 'ReminderMail'}
+
+
+def compile_mail_template(body):
+    # Literal text alternated with the names of variables
+    return MAIL_VARIABLES.split(body)
+
+
+def render_mail_template(segments, values):
+    return ''.join(values[segment] if index % 2 else segment for index, segment in enumerate(segments))
+
+
+class MailRenderer:
+    """Fill in the mails of caselists for many members
+
+    The templates are compiled once per caselist and mail type, the site and caselist urls are looked up once. The
+    usercaselists should come with their User and CaseList, e.g. from select_related('User', 'CaseList').
+    """
+    def __init__(self):
+        self.site = None
+        self.templates = {}
+        self.caselist_urls = {}
+
+    def template(self, caselist, mail_type):
+        key = (caselist.pk, mail_type)
+        if key not in self.templates:
+            self.templates[key] = compile_mail_template(getattr(caselist, MAIL_FIELDS[mail_type]))
+        return self.templates[key]
+
+    def caselist_url(self, caselist):
+        if caselist.pk not in self.caselist_urls:
+            if self.site is None:
+                self.site = str(Site.objects.get_current())
+            self.caselist_urls[caselist.pk] = self.site + reverse('rateslide:caselist', args=[caselist.Slug])
+        return self.caselist_urls[caselist.pk]
+
+    def render(self, usercaselist, mail_type):
+        if mail_type not in MAIL_FIELDS:
+            return "Invalid mail_type"
+        caselist = usercaselist.CaseList
+        user = usercaselist.User
+        values = {'first_name': user.first_name, 'last_name': user.last_name, 'username': user.username,
+                  'deadline': caselist.EndDate.strftime('%d-%m-%Y'), 'caselisturl': self.caselist_url(caselist)}
+        return render_mail_template(self.template(caselist, mail_type), values)
+
 
 def get_usercaselist_mailbody(usercaselist, mail_type):
     """
-    Send an email to a member of a usercaselist
+    Get the mail to a member of a usercaselist
     Make string substitutions for several variables
     %first_name%
     %last_name%
@@ -19,23 +69,7 @@ def get_usercaselist_mailbody(usercaselist, mail_type):
     %deadline%
     %caselisturl%
     """
-    def substitute_variables(body):
-        body = body.replace('%first_name%', usercaselist.User.first_name)
-        body = body.replace('%last_name%', usercaselist.User.last_name)
-        body = body.replace('%username%', usercaselist.User.username)
-        body = body.replace('%deadline%', usercaselist.CaseList.EndDate.strftime('%d-%m-%Y'))
-        body = body.replace('%caselisturl%', str(Site.objects.get_current()) + reverse('rateslide:caselist',
-                            args=[usercaselist.CaseList.id, ]))
-        return body
-    if mail_type == 'invite':
-        message = substitute_variables(usercaselist.CaseList.InviteMail)
-    elif mail_type == 'welcome':
-        message = substitute_variables(usercaselist.CaseList.WelcomeMail)
-    elif mail_type == 'reminder':
-        message = substitute_variables(usercaselist.CaseList.ReminderMail)
-    else:
-        message = "Invalid mail_type"
-    return message
+    return MailRenderer().render(usercaselist, mail_type)
 
 
 def get_mailbody(context, templatestr):
@@ -43,11 +77,6 @@ def get_mailbody(context, templatestr):
     return t.render(context)
 
 
-def send_usercaselist_mail(usercaselist, mail_type):
-    send_mail(mail_type, get_usercaselist_mailbody(usercaselist, mail_type), usercaselist.CaseList.Owner.email,
-              [usercaselist.User.email])
-
-
 def random_string(length):
     return ''.join(random.choice(string.ascii_letters) for _ in range(length))
 
@@ -56,8 +85,15 @@ ANONONYMOUS_NAME_LENGTH = 30
 
 
 def create_anonymous_user():
-    return User.objects.create_user(username=random_string(ANONONYMOUS_NAME_LENGTH),
+    user = User.objects.create_user(username=random_string(ANONONYMOUS_NAME_LENGTH),
                                     first_name='Anonymous', last_name='User')
+    AnonymousParticipant.objects.create(User=user)
+    return user
+
+
+def anonymous_visitor():
+    # An unsaved user for a visitor that did not submit answers yet
+    return User(username='', first_name='Anonymous', last_name='User')
 
 @register.filter
 def get_choice(choices, value):
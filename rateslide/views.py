@@ -4,49 +4,57 @@
 from json import dumps, loads
 import logging
 
-from os import path
-from collections import Counter
-from statistics import mean, stdev
-
 from django.shortcuts import render
-from django.http import HttpResponseRedirect, Http404, HttpResponse, JsonResponse
+from django.http import HttpResponseRedirect, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.core.exceptions import ObjectDoesNotExist, SuspiciousOperation
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_protect, csrf_exempt
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.db import transaction
 
 from invitation.forms import InvitationKeyForm
 from histoslide.models import Slide
 
 from .models import Case, Question, CaseInstance, Answer, AnswerAnnotation, CaseList, UserCaseList, CaseBookmark, \
-                   QuestionBookmark, QuestionItem
+                   QuestionBookmark, CaseListScore, QuestionStatistics, TextSketch, OutgoingMail
 from .forms import CaseListForm, UserCaseListSelectFormSet, tempUserFormSet, CaseInstancesSelectFormSet, \
                    CasesSelectFormSet, QuestionForm
-from .utils import send_usercaselist_mail, create_anonymous_user
-
-import numpy as np
-import matplotlib
-# Force matplotlib to not use any UI backend.
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib.colors import Normalize, to_hex
+from .assignment import select_next_case, submission_caseinstance
+from .caching import bump_version
+from .utils import anonymous_visitor, create_anonymous_user
+from .mail import queue_mail
+from .anonymous import delete_in_batches, inactive_anonymous_usercaselists
+from .export import EXPORT_FORMATS, export_lines
 
 
 logger = logging.getLogger(__name__)
 
+PARTICIPANT_COOKIE = 'slideobs_user'
+PARTICIPANT_COOKIE_SALT = 'rateslide.participant'
+PARTICIPANT_COOKIE_AGE = 604800
+
+
+def usercaselist_statuses(user):
+    """Return the status of a user in each of their caselists, by caselist id
+
+    The statuses are loaded once and kept on the user object, which lives as long as the request. get_case_user
+    updates them when it adds the user to a caselist.
+    """
+    if not hasattr(user, '_usercaselist_statuses'):
+        user._usercaselist_statuses = dict(UserCaseList.objects.filter(User=user).values_list('CaseList', 'Status'))
+    return user._usercaselist_statuses
+
 
 def check_usercaselist(user, cl):
-    ucl = UserCaseList.objects.filter(User=user, CaseList=cl)
-    if ucl.exists():
-        return ucl[0].Status 
-    else:
+    if not user:
         return UserCaseList.NONE
+    return usercaselist_statuses(user).get(cl.pk, UserCaseList.NONE)
 
 
 def is_caselist_admin(user, cl):
-    return cl.Owner == user or user.is_staff
+    return cl.Owner_id == user.pk or user.is_staff
 
 
 def get_caselist_data_by_id(request, caselist_id):
@@ -55,7 +63,7 @@ def get_caselist_data_by_id(request, caselist_id):
 
 
 def get_caselist_data_by_slug(request, slug):
-    cl = CaseList.objects.get(Slug=slug)
+    cl = CaseList.get_cached_by_slug(slug)
     return get_caselist_data(request, cl)
 
 
@@ -65,11 +73,17 @@ def get_caselist_data(request, cl):
     user = get_case_user(request, cl, False)
     if user:
         if check_usercaselist(user, cl) != UserCaseList.NONE:
-            ud['case_completed'] = cl.cases_completed(user.pk)
-            ud['case_count_completed'] = len(ud['case_completed'])
-            ud['case_count_todo'] = len(cl.cases_todo(user.pk))
-            ud['case_count_total'] = len(cl.cases_total(user.pk))
-            ud['case_evaluation'] = cl.evaluation(user.pk)
+            progress = cl.progress(user.pk)
+            ud['case_completed'] = progress.completed
+            ud['case_count_completed'] = progress.count_completed
+            ud['case_count_todo'] = progress.count_todo
+            ud['case_count_total'] = progress.count_total
+            if user.pk is None:
+                ud['case_evaluation'] = ''
+            elif cl.Type == CaseList.EXAMINATION:
+                ud['case_evaluation'] = cl.score(user.pk)
+            else:
+                ud['case_evaluation'] = cl.evaluation(user.pk)
             ud['canAdmit'] = False
         else:
             ud['canAdmit'] = cl.OpenForRegistration
@@ -85,8 +99,8 @@ def get_caselist_data(request, cl):
     ud['ActiveUsers'] = clu.filter(Status=UserCaseList.ACTIVE).count()
     ud['PendingUsers'] = clu.filter(Status=UserCaseList.PENDING).count()
     ud['CompleteUsers'] = clu.filter(Status=UserCaseList.COMPLETE).count()
-    ud['AnonymousUsers'] = clu.filter(User__first_name='Anonymous', User__last_name='User').count()
-    return {'CaseList': cl, 'Users': clu.exclude(User__first_name='Anonymous', User__last_name='User'), 'UserDict': ud}
+    ud['AnonymousUsers'] = clu.filter(User__anonymousparticipant__isnull=False).count()
+    return {'CaseList': cl, 'Users': clu.filter(User__anonymousparticipant__isnull=True), 'UserDict': ud}
 
 
 def caselist(request, slug):
@@ -113,7 +127,10 @@ def caselistadmin(request, slug):
         if not is_caselist_admin(request.user, cldata['CaseList']):
             raise Http404
         cldata['CaseListForm'] = CaseListForm(instance=cldata['CaseList'])
-        cldata['UserFormSet'] = UserCaseListSelectFormSet(queryset=cldata['Users'], initial=[{'selected': u'on', }])
+        cldata['UserFormSet'] = UserCaseListSelectFormSet(queryset=cldata['Users'].select_related('User'),
+                                                          initial=[{'selected': u'on', }])
+        # Count the progress of all listed users at once in stead of per row in the template
+        cldata['CaseList'].attach_user_progress([userform.instance for userform in cldata['UserFormSet']])
         cldata['InviteUser'] = InvitationKeyForm()
     except CaseList.DoesNotExist:
         raise Http404
@@ -128,9 +145,49 @@ def caselistreport(request, slug):
             raise Http404
     except CaseList.DoesNotExist:
         raise Http404
+    if cldata['CaseList'].Type == CaseList.OBSERVER:
+        # numpy is only loaded for the agreement statistics of observer variability lists
+        from .analysis import cached_agreement_report
+        report = cached_agreement_report(cldata['CaseList'])
+        cldata['Agreement'], cldata['AgreementComputed'] = report['questions'], report['computed']
     return render(request, 'rateslide/caselistreport.html', cldata)
 
 
+@login_required()
+def caselistexport(request, slug):
+    try:
+        cl = CaseList.objects.get(Slug=slug)
+    except CaseList.DoesNotExist:
+        raise Http404
+    if not is_caselist_admin(request.user, cl):
+        raise Http404
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        raise Http404
+    response = StreamingHttpResponse(export_lines(cl, export_format),
+                                     content_type='text/csv' if export_format == 'csv' else 'text/tab-separated-values')
+    response['Content-Disposition'] = 'attachment; filename="{0}.{1}"'.format(cl.Slug, export_format)
+    return response
+
+
+@login_required()
+def caselistmatrix(request, slug):
+    try:
+        cl = CaseList.objects.get(Slug=slug)
+    except CaseList.DoesNotExist:
+        raise Http404
+    if not is_caselist_admin(request.user, cl):
+        raise Http404
+    # numpy is only loaded when a matrix is requested
+    from .analysis import matrix_formats, observer_matrix_bytes
+    matrix_format = request.GET.get('format', 'npz')
+    if matrix_format not in matrix_formats():
+        raise Http404
+    response = HttpResponse(observer_matrix_bytes(cl, matrix_format), content_type='application/octet-stream')
+    response['Content-Disposition'] = 'attachment; filename="{0}.{1}"'.format(cl.Slug, matrix_format)
+    return response
+
+
 @login_required()
 def caseadd(request, slug):
     try:
@@ -161,10 +218,7 @@ def submitcaselist(request, caselist_id):
 
 
 def deleteemptyanonymoususercaselists(cl):
-    ucl = UserCaseList.objects.filter(CaseList=cl, User__first_name='Anonymous', User__last_name='User')
-    for user in ucl:
-        if user.case_count_completed() == 0:
-            user.delete()
+    return delete_in_batches(inactive_anonymous_usercaselists(cl))
 
 
 @csrf_protect
@@ -177,21 +231,16 @@ def submitcaselistusers(request, caselist_id):
         else:
             ucl = tempUserFormSet(request.POST, request.FILES)
             if ucl.is_valid():
+                selected = [userform.cleaned_data['id'] for userform in ucl if userform.cleaned_data['selected']]
                 if request.POST['submit'] == 'submitactivate':
-                    for userform in ucl:
-                        if userform.cleaned_data['selected']:
-                            user = UserCaseList.objects.get(pk=userform.cleaned_data['id'])
-                            if user.Status == UserCaseList.PENDING:
-                                # Set all selected users to active, send mail
-                                user.Status = UserCaseList.ACTIVE
-                                user.save()
-                                send_usercaselist_mail(user, 'welcome')
+                    # Set all selected users to active, mail is sent from the outbox
+                    pending = list(UserCaseList.objects.filter(pk__in=selected, CaseList=cl,
+                                                               Status=UserCaseList.PENDING).values_list('pk', flat=True))
+                    UserCaseList.objects.filter(pk__in=pending).update(Status=UserCaseList.ACTIVE)
+                    queue_mail(pending, OutgoingMail.WELCOME)
                 if request.POST['submit'] == 'submitreminder':
-                    for userform in ucl:
-                        if userform.cleaned_data['selected']:
-                            user = UserCaseList.objects.get(pk=userform.cleaned_data['id'])
-                            if user.Status == UserCaseList.ACTIVE:
-                                send_usercaselist_mail(user, 'reminder')
+                    queue_mail(UserCaseList.objects.filter(pk__in=selected, CaseList=cl, Status=UserCaseList.ACTIVE).
+                               values_list('pk', flat=True), OutgoingMail.REMINDER)
             else:
                 raise Exception('notvalid')
     else:
@@ -235,24 +284,62 @@ def submitusercaselist(request, usercaselist_id):
                 for userform in tmplst:
                     if userform.cleaned_data['selected']:
                         caseinstance = CaseInstance.objects.get(pk=userform.cleaned_data['id'])
-                        caseinstance.delete()
+                        grades = caseinstance_grade_counts(caseinstance)
+                        with transaction.atomic():
+                            removals = QuestionStatistics.answer_removals(
+                                Answer.objects.filter(CaseInstance=caseinstance))
+                            caseinstance.delete()
+                            QuestionStatistics.update(removals)
+                            TextSketch.update(removals)
+                        if ucl.CaseList.Type == CaseList.EXAMINATION:
+                            CaseListScore.add(ucl.User_id, ucl.CaseList, -grades['correct'], -grades['graded'])
+                        elif ucl.CaseList.Type == CaseList.OBSERVER:
+                            bump_version('agreement', ucl.CaseList_id)
         else:
             raise Exception("notvalid")
     return HttpResponseRedirect(reverse('rateslide:usercaselist', kwargs={'usercaselist_id': usercaselist_id}))
 
 
 def get_cookie_user(request, mustexist):
-    if "slideobs_user" in request.COOKIES or mustexist:
-        users = User.objects.filter(username=request.COOKIES["slideobs_user"])
-        if users.count() == 1:
-            return users[0]
-        else:
-            raise Http404
-    else:
-        # Firsttime access, create a new session user
-        user = create_anonymous_user()
-        request.COOKIES['slideobs_user'] = user.username
-        return user
+    """Return the anonymous participant of a visitor, recognised by a signed cookie
+
+    A first-time visitor gets an unsaved user, so pages that are only read do not write. The user is created in the
+    database when mustexist is set, i.e. when the visitor submits answers. The user is kept on the request, so its
+    caselist statuses are loaded once per request.
+    """
+    user = getattr(request, 'slideobs_user', None)
+    if user is None:
+        user = get_participant(request)
+    if user is None or (mustexist and user.pk is None):
+        user = create_anonymous_user() if mustexist else anonymous_visitor()
+        user._usercaselist_statuses = {}
+    request.slideobs_user = user
+    return user
+
+
+def accept_unsigned_participant_cookie():
+    # Cookies from before signing hold the plain username, anyone who knows it can take over the participant. Only
+    # enable this for the week after upgrading, when those cookies expire.
+    return getattr(settings, 'RATESLIDE_ACCEPT_UNSIGNED_PARTICIPANT_COOKIE', False)
+
+
+def get_participant(request):
+    username = request.get_signed_cookie(PARTICIPANT_COOKIE, default=None, salt=PARTICIPANT_COOKIE_SALT)
+    if username is None and accept_unsigned_participant_cookie():
+        username = request.COOKIES.get(PARTICIPANT_COOKIE)
+    if not username:
+        return None
+    # A participant that was purged starts again as a new visitor
+    return User.objects.filter(username=username, anonymousparticipant__isnull=False).first()
+
+
+def set_participant_cookie(request, response):
+    # Only participants that are stored in the database get a cookie
+    user = getattr(request, 'slideobs_user', None)
+    if user is not None and user.pk is not None:
+        response.set_signed_cookie(PARTICIPANT_COOKIE, user.username, salt=PARTICIPANT_COOKIE_SALT,
+                                   max_age=PARTICIPANT_COOKIE_AGE)
+    return response
 
 
 def get_case_user(request, cl, mustexist):
@@ -262,8 +349,13 @@ def get_case_user(request, cl, mustexist):
         if cl.VisibleForNonUsers:
             # Allow anonymous access
             user = get_cookie_user(request, mustexist)
-            if check_usercaselist(user, cl) != UserCaseList.ACTIVE:
-                UserCaseList.objects.create(User=user, CaseList=cl, Status=UserCaseList.ACTIVE)
+            if user.pk is None:
+                # The visitor joins the caselist when the first answers are submitted
+                usercaselist_statuses(user)[cl.pk] = UserCaseList.ACTIVE
+            elif check_usercaselist(user, cl) != UserCaseList.ACTIVE:
+                # A user is in a caselist once, concurrent first requests find the row of the other
+                UserCaseList.objects.update_or_create(User=user, CaseList=cl, defaults={'Status': UserCaseList.ACTIVE})
+                usercaselist_statuses(user)[cl.pk] = UserCaseList.ACTIVE
             return user
         else:
             return None
@@ -272,7 +364,7 @@ def get_case_user(request, cl, mustexist):
 @csrf_protect
 def case(request, case_id):
     try:
-        c = Case.objects.get(pk=case_id)
+        c = Case.get_cached(case_id)
         user = get_case_user(request, c.Caselist, False)
         if not user:
             return HttpResponseRedirect(settings.LOGIN_URL)
@@ -289,14 +381,12 @@ def case(request, case_id):
     except Case.DoesNotExist:
         raise Http404
     response = render(request, 'rateslide/case.html', {'Case': c, 'Slides': s, 'Questions': q_f, 'Editor': editor})
-    if 'slideobs_user' in request.COOKIES and user.email == '':
-        response.set_cookie('slideobs_user', user.username, max_age=604800)
-    return response
+    return set_participant_cookie(request, response)
 
 
 def showcase(request, case_id):
     try:
-        c = Case.objects.get(pk=case_id)
+        c = Case.get_cached(case_id)
         s = c.Slides.all().order_by('caseslide__order')
         editor = is_caselist_admin(request.user, c.Caselist)
     except Case.DoesNotExist:
@@ -305,26 +395,25 @@ def showcase(request, case_id):
 
 def caseeval(request, case_id):
     try:
-        case = Case.objects.get(pk=case_id)
+        case = Case.get_cached(case_id)
         user = get_case_user(request, case.Caselist, False)
         if not user:
             raise Http404
-        caseinstance = CaseInstance.objects.filter(Case=case, User=user).first()
+        caseinstance = CaseInstance.objects.filter(Case=case, User=user).first() if user.pk else None
         if not caseinstance:
             raise Http404
     except Case.DoesNotExist:
         raise Http404
     s = case.Slides.all().order_by('caseslide__order')
     questions = Question.objects.filter(Case=case)
-    caseinstance = CaseInstance.objects.filter(Case=case, User=user).first()
-    if caseinstance:
-        answers = Answer.objects.filter(CaseInstance=caseinstance).select_related('Question')
-    else:
-        raise Http404
+    # Grade all answers of the caseinstance in one query
+    answers = Answer.objects.filter(CaseInstance=caseinstance).select_related('Question', 'answerannotation').\
+        with_choice_text().graded()
+    answers = {answer.Question_id: answer for answer in answers}
     graded_answers = 0
     correct_answers = 0
     for question in questions:
-        answer = answers.filter(Question = question).first()
+        answer = answers.get(question.pk)
         if answer:
             question.value = answer.textvalue()
             question.grade = answer.grade()
@@ -339,180 +428,183 @@ def caseeval(request, case_id):
         case.answers_evaluation = ''
 
     response = render(request, 'rateslide/caseeval.html', {'Case': case, 'Slides': s, 'Questions': questions})
-    if 'slideobs_user' in request.COOKIES and user.email == '':
-        response.set_cookie('slideobs_user', user.username, max_age=604800)
-    return response
+    return set_participant_cookie(request, response)
 
 def next_case(request, slug):
     # Get a unprocessed case from the user
-    cl = CaseList.objects.get(Slug=slug)
+    cl = CaseList.get_cached_by_slug(slug)
     user = get_case_user(request, cl, False)
     if check_usercaselist(user, cl):
-        todo = cl.get_next_case(user.pk)
+        if user.pk is None:
+            # A visitor is stored on the first valid submission, which checks the observer limit instead of a
+            # reservation
+            todo = select_next_case(cl, None)
+        else:
+            todo = cl.get_next_case(user.pk)
         if todo >= 0:
-            return HttpResponseRedirect(reverse('rateslide:case', kwargs={'case_id': todo}))
+            response = HttpResponseRedirect(reverse('rateslide:case', kwargs={'case_id': todo}))
         else:
-            return HttpResponseRedirect(reverse('home'))
+            response = HttpResponseRedirect(reverse('home'))
+        return set_participant_cookie(request, response)
     else:
         raise Http404
 
 
-def generate_report_histogram(data, question_id):
-    x = np.asarray(data)
-
-    fig, axs = plt.subplots(figsize=(3, 1))
-    n, bins, patches = axs.hist(x)
-    for i, patch in enumerate(patches):
-        color = plt.cm.viridis(i/(len(patches)-1))
-        patch.set_facecolor(color)
-    fname = 'questionresult/hist_{0:d}.png'.format(question_id)
-    fig.savefig(path.join(settings.MEDIA_ROOT, fname), dpi=100, bbox_inches='tight')
-    return settings.MEDIA_URL + fname
-
-
-def color_annotations_by(annotations, data):
-    x = np.asarray(data)
-    norm = Normalize(x.min(), x.max())
-    for i, annot in enumerate(annotations):
-        color = plt.cm.viridis(norm(x[i]))
-        annot['annotation'][1]['stroke'] = to_hex(color)
-
-
 @login_required()
 def casereport(request, case_id):
     try:
-        cs = Case.objects.get(pk=case_id)
+        cs = Case.get_cached(case_id)
         if not is_caselist_admin(request.user, cs.Caselist):
             raise Http404
         slides = cs.Slides.all().order_by('caseslide__order')
-        questions = Question.objects.filter(Case=cs).values()
-        for question in questions:
-            if question['Type'] == Question.NUMERIC:
-                answers = Answer.objects.filter(Question=question['id']).values_list('AnswerNumeric', flat=True)
-                question['total_answers'] = answers.count()
-                if answers.count() > 0:
-                    question['resultimage'] = generate_report_histogram(answers, question['id'])
-                    question['headings'] = ['min', 'max', 'avg', 'sd']
-                    if answers.count() > 1:
-                        std_dev = stdev(answers)
-                    else:
-                        std_dev = '-'
-                    question['data'] = [(min(answers), max(answers), mean(answers), std_dev)]
-
-            elif question['Type'] == Question.MULTIPLECHOICE:
-                answers = Answer.objects.filter(Question=question['id']).values_list('AnswerNumeric', flat=True)
-                question['total_answers'] = answers.count()
-                if answers.count() > 0:
-                    question['headings'] = ['n', '%', 'choice']
-                    questionitems = QuestionItem.objects.filter(Question=question['id']).order_by('Order').\
-                        values_list('Order', 'Text')
-                    counter = Counter(answers)
-                    question['data'] = [(counter[k], "{0:.0%}".
-                                         format(counter[k]/answers.count()), n) for (k, n) in questionitems]
-            elif question['Type'] == Question.DATE:
-                answers = Answer.objects.filter(Question=question['id']).values_list('AnswerNumeric', flat=True)
-                question['total_answers'] = answers.count()
-            elif question['Type'] == Question.LINE:
-                answers = Answer.objects.select_related('answerannotation').filter(Question=question['id'])
-                lengths = []
-                annots = []
-                lengthunit = set()
-                if answers.count() > 0:
-                    for answ in answers:
-                        if hasattr(answ, 'answerannotation'):
-                            lengths.append(answ.answerannotation.Length)
-                            annot = loads(answ.answerannotation.AnnotationJSON)
-                            annot.append(str(answ.id))
-                            annots.append({'slideid': answ.answerannotation.Slide_id, 'annotation': annot})
-                            lengthunit.add(answ.answerannotation.LengthUnit)
-                    question['total_answers'] = len(lengths)
-                    if len(lengths) > 0:
-                        question['resultimage'] = generate_report_histogram(lengths, question['id'])
-                        color_annotations_by(annots, lengths)
-                        if len(lengthunit) > 1:
-                            lengthunit = '-'
-                        else:
-                            lengthunit = lengthunit.pop()
-                        question['headings'] = ['min', 'max', 'avg', 'sd']
-                        if len(lengths) > 1:
-                            std_dev = '{0:.2g} {1:s}'.format(stdev(lengths), lengthunit)
-                        else:
-                            std_dev = '-'
-                        question['data'] = [('{0:.2g} {1:s}'.format(min(lengths), lengthunit),
-                                             '{0:.2g} {1:s}'.format(max(lengths), lengthunit),
-                                             '{0:.2g} {1:s}'.format(mean(lengths), lengthunit), std_dev)]
-                        question['annotations'] = dumps(annots)
-
-            else:  # OpenText
-                answers = Answer.objects.filter(Question=question['id']).exclude(AnswerText='').values_list('AnswerText', flat=True)
-                question['total_answers'] = answers.count()
-                if answers.count() > 0:
-                    question['headings'] = ['n', '%', 'text']
-                    counter = Counter(answers)
-                    question['data'] = [(n, "{0:.0%}".format(n/answers.count()), t, )
-                                        for (t, n) in counter.most_common(10)]
-
+        # Plotting libraries are only loaded when a report is requested
+        from .reports import case_report_questions
+        mode = request.GET.get('histograms')
+        questions = case_report_questions(cs, mode if mode in ('png', 'svg') else None)
     except Case.DoesNotExist:
         raise Http404
     return render(request, 'rateslide/casereport.html', {'Case': cs, 'Slides': slides, 'Questions': questions})
 
 
+def caseinstance_grade_counts(caseinstance):
+    # Only ended caseinstances count for the score
+    if caseinstance.Status == CaseInstance.ENDED:
+        return Answer.objects.filter(CaseInstance=caseinstance).grade_counts()
+    else:
+        return {'graded': 0, 'correct': 0}
+
+
+def save_case_answers(caseinstance, cleaned_data):
+    """Save the answers of a submitted QuestionForm with bulk queries
+
+    The question id and type are taken from the field id, existing answers of the caseinstance are loaded once.
+    Answers that are cleared are deleted, together with their annotation. The running statistics and text sketches
+    of the questions are updated with the removed and added values.
+    """
+    existing = {answer.Question_id: answer for answer in
+                Answer.objects.filter(CaseInstance=caseinstance).select_related('answerannotation')}
+    new_answers = []
+    changed_answers = []
+    deleted_answers = []
+    annotations = {}
+    changes = {}
+    for q_id, cleaned_answer in cleaned_data.items():
+        # Check if id has proper format for question
+        # 0:'question', 1:'R|F', 2:"M|N|O|D|R|L", 3:numeric id
+        id_elts = str.split(q_id, '_')
+        # Skip remarks
+        if len(id_elts) != 4 or id_elts[0] != 'question' or id_elts[2] == Question.REMARK:
+            continue
+        question_id = int(id_elts[3])
+        ans = existing.get(question_id)
+        change = changes[question_id] = (id_elts[2], [], [])
+        if ans and id_elts[2] in [Question.MULTIPLECHOICE, Question.NUMERIC]:
+            change[1].append(ans.AnswerNumeric)
+        elif ans and id_elts[2] == Question.LINE and hasattr(ans, 'answerannotation'):
+            change[1].append(ans.answerannotation.Length)
+        elif ans and id_elts[2] == Question.OPENTEXT and ans.AnswerText:
+            change[1].append(ans.AnswerText)
+        if cleaned_answer == '' or cleaned_answer is None:
+            if ans:
+                deleted_answers.append(ans.pk)
+            continue
+        if not ans:
+            ans = Answer(CaseInstance=caseinstance, Question_id=question_id)
+            new_answers.append(ans)
+        else:
+            changed_answers.append(ans)
+        if id_elts[2] in [Question.MULTIPLECHOICE, Question.NUMERIC]:
+            ans.AnswerNumeric = cleaned_answer
+            change[2].append(int(cleaned_answer))
+        elif id_elts[2] == Question.LINE:
+            # Answer contains a JSON packed annotation
+            annotation_data = loads(cleaned_answer)
+            ans.AnswerText = "{0:.3g} {1}".format(annotation_data['length'], annotation_data['length_unit'])
+            annotations[question_id] = annotation_data
+            change[2].append(float(annotation_data['length']))
+        else:
+            ans.AnswerText = str(cleaned_answer)
+            if id_elts[2] == Question.OPENTEXT:
+                change[2].append(ans.AnswerText)
+    if deleted_answers:
+        Answer.objects.filter(pk__in=deleted_answers).delete()
+    if changed_answers:
+        Answer.objects.bulk_update(changed_answers, ['AnswerNumeric', 'AnswerText'])
+    if new_answers:
+        Answer.objects.bulk_create(new_answers)
+    if annotations:
+        # bulk_create does not return primary keys on every database, look up the answers of the annotations
+        answer_ids = dict(Answer.objects.filter(CaseInstance=caseinstance, Question__in=annotations.keys()).
+                          values_list('Question', 'pk'))
+        new_annotations = []
+        changed_annotations = []
+        for question_id, annotation_data in annotations.items():
+            ans = existing.get(question_id)
+            if ans and hasattr(ans, 'answerannotation'):
+                annotation = ans.answerannotation
+                changed_annotations.append(annotation)
+            else:
+                annotation = AnswerAnnotation(answer_id=answer_ids[question_id])
+                new_annotations.append(annotation)
+            annotation.Slide_id = annotation_data['slideid']
+            annotation.Length = annotation_data['length']
+            annotation.LengthUnit = annotation_data['length_unit']
+            annotation.AnnotationJSON = dumps(annotation_data['annotation'])
+        if changed_annotations:
+            AnswerAnnotation.objects.bulk_update(changed_annotations, ['Slide', 'Length', 'LengthUnit',
+                                                                       'AnnotationJSON'])
+        if new_annotations:
+            AnswerAnnotation.objects.bulk_create(new_annotations)
+    # Resubmitted values that did not change are left alone
+    changes = {question_id: change for question_id, change in changes.items() if change[1] != change[2]}
+    QuestionStatistics.update(changes)
+    TextSketch.update(changes)
+
+
 @csrf_protect
 def submitcase(request, case_id): 
     try:
         if request.method == 'POST':
             # Check if case has been registered by user
-            cs = Case.objects.get(pk=case_id)
-            user = get_case_user(request, cs.Caselist, True)
+            cs = Case.get_cached(case_id)
+            user = get_case_user(request, cs.Caselist, False)
             if not (check_usercaselist(user, cs.Caselist) and user):
                 raise Http404
             form = QuestionForm(cs, user, request.POST)
             if form.is_valid():
-                ci, _ = CaseInstance.objects.get_or_create(Case=cs, User=user, defaults={'Status': 'E'})
-                for q_id in form.cleaned_data:
-                    # Check if id has proper format for question
-                    # 0:'question', 1:'R|F', 2:"M|N|O|D|R|L", 3:numeric id
-                    id_elts = str.split(q_id, '_')
-                    if len(id_elts) == 4:
-                        # Skip remarks
-                        if id_elts[0] == 'question' and id_elts[2] != "R":
-                            question = Question.objects.get(pk=id_elts[3])
-                            ans, _ = Answer.objects.get_or_create(CaseInstance=ci, Question=question)
-                            cleaned_answer = form.cleaned_data[q_id]
-                            if id_elts[2] in [Question.MULTIPLECHOICE, Question.NUMERIC]:
-                                if cleaned_answer != '' and cleaned_answer is not None:
-                                    ans.AnswerNumeric = cleaned_answer
-                                    ans.save()
-                                else:
-                                    ans.delete()
-                            elif id_elts[2] == Question.LINE:
-                                # Answer contains a JSON packed annotation
-                                if cleaned_answer != '':
-                                    annotation_data = loads(cleaned_answer)
-                                    ans.AnswerText = "{0:.3g} {1}".format(annotation_data['length'],
-                                                                          annotation_data['length_unit'])
-                                    ans.save()
-                                    AnswerAnnotation.objects.update_or_create(answer=ans, defaults=
-                                                           {'Slide': Slide.objects.get(pk=annotation_data['slideid']),
-                                                            'Length': annotation_data['length'],
-                                                            'LengthUnit': annotation_data['length_unit'],
-                                                            'AnnotationJSON': dumps(annotation_data['annotation'])})
-                                else:
-                                    if hasattr(ans, 'answerannotation'):
-                                        ans.answerannotation.delete(keep_parents=True)
-                                    ans.delete()
-                            else:
-                                if cleaned_answer != '':
-                                    ans.AnswerText = cleaned_answer
-                                    ans.save()
-                                else:
-                                    ans.delete()
+                if user.pk is None:
+                    # The first valid submission of a visitor creates the participant
+                    user = get_case_user(request, cs.Caselist, True)
+                with transaction.atomic():
+                    ci = submission_caseinstance(cs, user.pk)
+                    if ci is None:
+                        # The reservation expired and the case was given to other observers
+                        response = render(request, 'rateslide/case.html',
+                                          {'Case': cs, 'Slides': cs.Slides.all(), 'Questions': form,
+                                           'Message': 'Your reservation of this case has expired and the case has '
+                                                      'been given to other observers. Your answers were not saved.'})
+                        return set_participant_cookie(request, response)
+                    keep_score = cs.Caselist.Type == CaseList.EXAMINATION
+                    if keep_score:
+                        grades_before = caseinstance_grade_counts(ci)
+                    if ci.Status == CaseInstance.OPEN:
+                        # The case was reserved for this user
+                        ci.Status = CaseInstance.ENDED
+                        ci.save()
+                    save_case_answers(ci, form.cleaned_data)
+                    if keep_score:
+                        grades_after = caseinstance_grade_counts(ci)
+                        CaseListScore.add(user.pk, cs.Caselist, grades_after['correct'] - grades_before['correct'],
+                                          grades_after['graded'] - grades_before['graded'])
+                if cs.Caselist.Type == CaseList.OBSERVER:
+                    bump_version('agreement', cs.Caselist_id)
                 if cs.Report != "" and cs.Caselist.Type == CaseList.EXAMINATION:
-                    return HttpResponseRedirect(reverse('rateslide:caseeval', kwargs={'case_id': case_id}))
+                    response = HttpResponseRedirect(reverse('rateslide:caseeval', kwargs={'case_id': case_id}))
                 elif request.POST['submit'] == 'submit':
-                    return HttpResponseRedirect(reverse('rateslide:caselist', kwargs={'slug': cs.Caselist.Slug}))
+                    response = HttpResponseRedirect(reverse('rateslide:caselist', kwargs={'slug': cs.Caselist.Slug}))
                 else:
-                    return next_case(request, cs.Caselist.Slug)
+                    response = next_case(request, cs.Caselist.Slug)
+                return set_participant_cookie(request, response)
             else:
                 return render(request, 'rateslide/case.html',
                               {'Case': cs, 'Slides': cs.Slides.all(), 'Questions': form})
@@ -523,15 +615,15 @@ def submitcase(request, case_id):
 @login_required()
 def apply_for_invitation(request, slug):
     # Request to enter a case list
-    cl = CaseList.objects.get(Slug=slug)
+    cl = CaseList.get_cached_by_slug(slug)
     if check_usercaselist(request.user, cl) == UserCaseList.NONE:
         if cl.SelfRegistration:
-            ucl = UserCaseList(User=request.user, CaseList=cl, Status=UserCaseList.ACTIVE)
+            status = UserCaseList.ACTIVE
             # TODO: Send welcome mail
         else:
-            ucl = UserCaseList(User=request.user, CaseList=cl, Status=UserCaseList.PENDING)
+            status = UserCaseList.PENDING
         # TODO: send mail to owner of caselist
-        ucl.save()
+        UserCaseList.objects.get_or_create(User=request.user, CaseList=cl, defaults={'Status': status})
         return HttpResponseRedirect('/')    
     else:
         # User is already registered for this list
@@ -2,7 +2,7 @@ import os
 from setuptools import find_packages, setup
 
 install_requires = [
-    'Django>=2.0',
+    'Django>=2.2',
     'django-extensions>=2.0',
     'django-nested-admin>=3.2.4',
 ]